@@ -1,50 +1,83 @@
-from comparisons import gt, gte, lt, lte
-
-
-def add_groupings(df):
+from group_rules import (
+    all_of,
+    any_of,
+    at_least,
+    below,
+    compile_vectorised,
+    date,
+    equals,
+    gt,
+    gte,
+    is_null,
+    is_set,
+    lte,
+)
+
+# The rule for each group, in the order in which they are added.  Some rules depend
+# on groups that come before them.  transform_fast evaluates the rules with
+# add_groupings, and transform_slow with add_groupings_2.
+group_rules = [
     # Patients with a vaccination
-    df["vacc_group"] = df["vacc1_dat"].notnull() | df["vacc2_dat"].notnull()
+    ("vacc_group", any_of(is_set("vacc1_dat"), is_set("vacc2_dat"))),
 
     # Patients with a decline (but no vaccination - already incorporated in decl_date)
-    df["decline_group"] = df["decl_dat"].notnull()
+    ("decline_group", is_set("decl_dat")),
 
     # Patients with a decline (irrespective of vaccination status)
-    df["decline_total_group"] = df["decl_first_dat"].notnull() 
+    ("decline_total_group", is_set("decl_first_dat")),
 
     # Patients with a decline and a later vaccination
     # check that declined date is within the vaccination campaign period not in the past
     # (otherwise exclude, as unable determine correct sequence of events)
-    df["declined_accepted_group"] =  gt(df["vacc1_dat"], df["decl_first_dat"]) & (
-                                     df["decl_first_dat"] >= "2020-12-08") & (
-                                     df["vacc1_dat"] >= "2020-12-08"
-                                     )
+    (
+        "declined_accepted_group",
+        all_of(
+            gt("vacc1_dat", "decl_first_dat"),
+            gte("decl_first_dat", date("2020-12-08")),
+            gte("vacc1_dat", date("2020-12-08")),
+        ),
+    ),
 
     # Any other patients with both a decline and a vaccination (but first vaccine did not follow first decline)
-    df["vaccinated_and_declined_group"] =  df["decline_total_group"] & (
-                                           df["vacc_group"]==True) & (
-                                           df["declined_accepted_group"]==False
-                                           )
+    (
+        "vaccinated_and_declined_group",
+        all_of(
+            is_set("decline_total_group"),
+            is_set("vacc_group"),
+            is_null("declined_accepted_group"),
+        ),
+    ),
 
     # Patients with any other record related to vaccination (and no vaccination or decline)
-    ## indicates an attempt or intention to vaccinate but 
+    ## indicates an attempt or intention to vaccinate but
     ## (apparently) unsuccessful for reasons other than declining
-    df["other_reason_group"] = (df["covnot_dat"].notnull() | df["covnot_imms_dat"].notnull()) & (
-                                df["vacc1_dat"].isnull()) & (df["decl_dat"].isnull())
+    (
+        "other_reason_group",
+        all_of(
+            any_of(is_set("covnot_dat"), is_set("covnot_imms_dat")),
+            is_null("vacc1_dat"),
+            is_null("decl_dat"),
+        ),
+    ),
 
     # Patients with Immunosuppression
     #
     # IF IMMRX_DAT <> NULL     | Select | Next
     # IF IMMDX_COV_DAT <> NULL | Select | Reject
-    df["immuno_group"] = df["immrx_dat"].notnull() | df["immdx_cov_dat"].notnull()
+    ("immuno_group", any_of(is_set("immrx_dat"), is_set("immdx_cov_dat"))),
 
     # Patients with CKD
     #
     # IF CKD_COV_DAT <> NULL (diagnoses) | Select | Next
     # IF CKD15_DAT = NULL  (No stages)   | Reject | Next
     # IF CKD35_DAT>=CKD15_DAT            | Select | Reject
-    df["ckd_group"] = df["ckd_cov_dat"].notnull() | (
-        df["ckd15_dat"].notnull() & gte(df["ckd35_dat"], df["ckd15_dat"])
-    )
+    (
+        "ckd_group",
+        any_of(
+            is_set("ckd_cov_dat"),
+            all_of(is_set("ckd15_dat"), gte("ckd35_dat", "ckd15_dat")),
+        ),
+    ),
 
     # Patients with Asthma
     #
@@ -53,43 +86,49 @@ def add_groupings(df):
     # IF ASTRXM1 <> NULL    | Next   | Reject
     # IF ASTRXM2 <> NULL    | Next   | Reject
     # IF ASTRXM3 <> NULL    | Select | Reject
-    df["ast_group"] = df["astadm_dat"].notnull() | (
-        df["ast_dat"].notnull()
-        & df["astrxm1_dat"].notnull()
-        & df["astrxm2_dat"].notnull()
-        & df["astrxm3_dat"].notnull()
-    )
+    (
+        "ast_group",
+        any_of(
+            is_set("astadm_dat"),
+            all_of(
+                is_set("ast_dat"),
+                is_set("astrxm1_dat"),
+                is_set("astrxm2_dat"),
+                is_set("astrxm3_dat"),
+            ),
+        ),
+    ),
 
     # Patients with CNS Disease (including Stroke/TIA)
     #
     # IF CNS_COV_DAT <> NULL | Select | Reject
-    df["cns_group"] = df["cns_cov_dat"].notnull()
+    ("cns_group", is_set("cns_cov_dat")),
 
     # Patients who have Chronic Respiratory Disease
     #
     # IF AST_GROUP <> NULL    | Select | Next
     # IF RESP_COV_DAT <> NULL | Select | Reject
-    df["resp_group"] = df["ast_group"] | df["resp_cov_dat"].notnull()
+    ("resp_group", any_of(is_set("ast_group"), is_set("resp_cov_dat"))),
 
     # Patients with Morbid Obesity
     #
     # IF SEV_OBESITY_DAT > BMI_DAT | Select | Next
     # IF BMI_VAL >=40              | Select | Reject
-    df["bmi_group"] = gt(df["sev_obesity_dat"], df["bmi_dat"]) | (df["bmi_val"] >= 40)
+    ("bmi_group", any_of(gt("sev_obesity_dat", "bmi_dat"), at_least("bmi_val", 40))),
 
     # Patients with Diabetes
     #
     # IF DIAB_DAT > DMRES_DAT | Select | Reject
-    df["diab_group"] = gt(df["diab_dat"], df["dmres_dat"])
+    ("diab_group", gt("diab_dat", "dmres_dat")),
 
     # Patients with Severe Mental Health
     #
     # IF SEV_MENTAL_DAT > SMHRES_DAT | Select | Reject
-    df["sevment_group"] = gt(df["sev_mental_dat"], df["smhres_dat"])
+    ("sevment_group", gt("sev_mental_dat", "smhres_dat")),
 
     # Patients with Learning disability
     #
-    df["learndis_group"] = df["learndis_dat"].notnull()
+    ("learndis_group", is_set("learndis_dat")),
 
     # Patients in Any Clinical Risk Group
     #
@@ -103,33 +142,40 @@ def add_groupings(df):
     # IF SPLN_COV_DAT <> NULL  | Select | Next
     # IF LEARNDIS_DAT <> NULL  | Select | Next
     # IF SEVMENT_GROUP <> NULL | Select | Reject
-    df["atrisk_group"] = (
-        df["immuno_group"]
-        | df["ckd_group"]
-        | df["resp_group"]
-        | df["diab_group"]
-        | df["cld_dat"].notnull()
-        | df["cns_group"]
-        | df["chd_cov_dat"].notnull()
-        | df["spln_cov_dat"].notnull()
-        | df["learndis_dat"].notnull()
-        | df["sevment_group"]
-    )
+    (
+        "atrisk_group",
+        any_of(
+            is_set("immuno_group"),
+            is_set("ckd_group"),
+            is_set("resp_group"),
+            is_set("diab_group"),
+            is_set("cld_dat"),
+            is_set("cns_group"),
+            is_set("chd_cov_dat"),
+            is_set("spln_cov_dat"),
+            is_set("learndis_dat"),
+            is_set("sevment_group"),
+        ),
+    ),
 
     # Patients who have received at least 1 dose of a COVID Vaccination
     #
     # IF COVRX1_DAT <> NULL  | Select | Next
     # IF COVADM1_DAT <> NULL | Select | Reject
-    df["covax1d_group"] = df["covrx1_dat"].notnull() | df["covadm1_dat"].notnull()
+    ("covax1d_group", any_of(is_set("covrx1_dat"), is_set("covadm1_dat"))),
 
     # Patients who have received at least 2 doses of a COVID Vaccination
     #
     # IF COVAX1D_GROUP <> NULL | Next   | Reject
     # IF COVRX2_DAT <> NULL    | Select | Next
     # IF COVADM2_DAT <> NULL   | Select | Reject
-    df["covax2d_group"] = df["covax1d_group"] & (
-        df["covrx2_dat"].notnull() | df["covadm2_dat"].notnull()
-    )
+    (
+        "covax2d_group",
+        all_of(
+            is_set("covax1d_group"),
+            any_of(is_set("covrx2_dat"), is_set("covadm2_dat")),
+        ),
+    ),
 
     # Patients who have an unstated dose 1 vaccination type
     #
@@ -141,16 +187,19 @@ def add_groupings(df):
     # IF JND1RX _DAT <> NULL   | Reject | Next
     # IF GSD1RX_DAT <> NULL    | Reject | Next
     # IF VLD1RX_DAT <> NULL    | Reject | Select
-    df["unstatvacc1_group"] = (
-        df["covax1d_group"]
-        & df["azd1rx_dat"].isnull()
-        & df["pfd1rx_dat"].isnull()
-        & df["mod1rx_dat"].isnull()
-        & df["nxd1rx_dat"].isnull()
-        & df["jnd1rx_dat"].isnull()
-        & df["gsd1rx_dat"].isnull()
-        & df["vld1rx_dat"].isnull()
-    )
+    (
+        "unstatvacc1_group",
+        all_of(
+            is_set("covax1d_group"),
+            is_null("azd1rx_dat"),
+            is_null("pfd1rx_dat"),
+            is_null("mod1rx_dat"),
+            is_null("nxd1rx_dat"),
+            is_null("jnd1rx_dat"),
+            is_null("gsd1rx_dat"),
+            is_null("vld1rx_dat"),
+        ),
+    ),
 
     # Patients who have an unstated dose 2 vaccination type
     #
@@ -162,32 +211,45 @@ def add_groupings(df):
     # IF JND2RX _DAT <> NULL   | Reject | Next
     # IF GSD2RX_DAT <> NULL    | Reject | Next
     # IF VLD2RX_DAT <> NULL    | Reject | Select
-    df["unstatvacc2_group"] = (
-        df["covax2d_group"]
-        & df["azd2rx_dat"].isnull()
-        & df["pfd2rx_dat"].isnull()
-        & df["mod2rx_dat"].isnull()
-        & df["nxd2rx_dat"].isnull()
-        & df["jnd2rx_dat"].isnull()
-        & df["gsd2rx_dat"].isnull()
-        & df["vld2rx_dat"].isnull()
-    )
+    (
+        "unstatvacc2_group",
+        all_of(
+            is_set("covax2d_group"),
+            is_null("azd2rx_dat"),
+            is_null("pfd2rx_dat"),
+            is_null("mod2rx_dat"),
+            is_null("nxd2rx_dat"),
+            is_null("jnd2rx_dat"),
+            is_null("gsd2rx_dat"),
+            is_null("vld2rx_dat"),
+        ),
+    ),
 
     # Patients who are shielding (High Risk from COVID-19)
     #
     # IF SHIELD_DAT = NULL                           | Reject | Next
     # IF SHIELD_DAT <> NULL AND NONSHIELD_DAT = NULL | Select | Next
     # IF SHIELD_DAT > NONSHIELD_DAT                  | Select | Reject
-    df["shield_group"] = df["shield_dat"].notnull() & (
-        (df["shield_dat"].notnull() & df["nonshield_dat"].isnull())
-        | gt(df["shield_dat"], df["nonshield_dat"])
-    )
+    #
+    # (gt selects both of the last two cases)
+    ("shield_group", gt("shield_dat", "nonshield_dat")),
 
     # Patients who are pregnant
     #
     # IF PREG_DAT<> NULL        | Next   | Reject
     # IF PREGDEL_DAT > PREG_DAT | Reject | Select
-    df["preg_group"] = df["preg_dat"].notnull() & lte(df["pregdel_dat"], df["preg_dat"]) & (
-                        df["sex"]=="F") & (df["age"]<50
-                        )
+    (
+        "preg_group",
+        all_of(
+            is_set("preg_dat"),
+            lte("pregdel_dat", "preg_dat"),
+            equals("sex", "F"),
+            below("age", 50),
+        ),
+    ),
+]
+
 
+def add_groupings(df):
+    for group, rule in group_rules:
+        df[group] = compile_vectorised(rule)(df)
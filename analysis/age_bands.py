@@ -1,6 +1,3 @@
-import numpy as np
-
-
 # Mapping from age band to (lower, upper).  The lower limit is inclusive, the upper
 # limit is exclusive.
 age_bands = {
@@ -23,19 +20,3 @@ age_bands = {
     17: (65, 75),
     18: (75, None),
 }
-
-
-def add_age_bands(df, bands):
-    df["age_band"] = np.nan
-
-    for band in bands:
-        lower, upper = age_bands[band]
-        mask = df["age_band"].isna()
-        if lower is not None:
-            mask &= lower <= df["age"]
-        if upper is not None:
-            mask &= df["age"] < upper
-        df["age_band"].where(~mask, band, inplace=True)
-
-    assert df["age_band"].all()
-    df["age_band"] = df["age_band"].astype(int)
@@ -0,0 +1,122 @@
+"""Map IMD, ethnicity and age onto the bands used in the outputs.
+
+Each mapping is done in a single pass over a column: IMD and age by searching a
+sorted array of band boundaries, and ethnicity by indexing a lookup array with the
+ethnicity code.  transform_fast maps whole columns with the functions below, and
+transform_slow maps single values with the same boundaries and lookups.
+"""
+
+import csv
+from bisect import bisect_right
+from functools import lru_cache
+
+import numpy as np
+
+from age_bands import age_bands
+
+# The boundaries of the five IMD bands, from 1 (most deprived) to 5 (least
+# deprived).  IMD is a rank from 1 to 32844.
+imd_boundaries = np.array([band * 32844 / 5 for band in range(0, 5 + 1)])
+imd_upper_boundaries = imd_boundaries[1:].tolist()
+
+
+def imd_bands(imd):
+    """Return the IMD band of each value of an array of IMD ranks, or 0 if missing.
+
+    Values that fall on or outside the boundaries (including 0) are given band 0.
+    """
+
+    imd = np.asarray(imd, dtype=float)
+    # position is the band such that imd_boundaries[band - 1] < imd <= imd_boundaries[band]
+    position = np.searchsorted(imd_boundaries, imd, side="left")
+    in_range = (position >= 1) & (position <= 5)
+    bands = np.where(in_range, position, 0)
+    bands[in_range & (imd == imd_boundaries[np.minimum(position, 5)])] = 0
+    return bands
+
+
+def imd_band(imd):
+    """Return the IMD band of a single IMD rank, or None if it is beyond the last
+    boundary.
+
+    Unlike imd_bands, a rank of 0 or below is given band 1.
+    """
+
+    band = bisect_right(imd_upper_boundaries, imd) + 1
+    if band > 5:
+        return None
+    return band
+
+
+@lru_cache()
+def get_high_level_ethnicity_lookup():
+    """Return an array mapping ethnicity (1-20) to high-level ethnicity (1-6).
+
+    Categories 1-16 are mapped to high-level categories 1-5 as in the codelist, and
+    every other category to 6 ("unknown").
+    """
+
+    category_to_high_level_category = {}
+    with open("codelists/primis-covid19-vacc-uptake-eth2001.csv") as f:
+        for record in csv.DictReader(f):
+            category = int(record["grouping_16_id"])
+            high_level_category = int(record["grouping_6_id"])
+
+            if category in category_to_high_level_category:
+                assert category_to_high_level_category[category] == high_level_category
+            else:
+                category_to_high_level_category[category] = high_level_category
+
+    lookup = np.full(20 + 1, 6, dtype="int8")
+    for category, high_level_category in category_to_high_level_category.items():
+        lookup[category] = high_level_category
+    return lookup
+
+
+def high_level_ethnicities(ethnicity):
+    """Return the high-level ethnicity of each value of an array of ethnicities."""
+
+    lookup = get_high_level_ethnicity_lookup()
+    ethnicity = np.asarray(ethnicity)
+    in_range = (ethnicity >= 0) & (ethnicity < len(lookup))
+    return np.where(in_range, lookup[np.where(in_range, ethnicity, 0)], 6).astype(
+        "int8"
+    )
+
+
+@lru_cache()
+def get_age_band_lookup(bands):
+    """Return the boundaries of the given age bands, and an array mapping each
+    interval between boundaries to a band.
+
+    Bands may overlap (for instance, bands 13 to 18), in which case an age is given
+    the first of `bands` that contains it, and 0 if there is none.
+    """
+
+    boundaries = sorted(
+        {limit for band in bands for limit in age_bands[band] if limit is not None}
+    )
+
+    # The interval at position ix contains the ages from boundaries[ix - 1]
+    # (inclusive) to boundaries[ix] (exclusive), with no lower limit for the first
+    # and no upper limit for the last.
+    lookup = np.zeros(len(boundaries) + 1, dtype=np.int64)
+    for ix in range(len(boundaries) + 1):
+        for band in bands:
+            lower, upper = age_bands[band]
+            if lower is not None and (ix == 0 or boundaries[ix - 1] < lower):
+                continue
+            if upper is not None and (ix == len(boundaries) or boundaries[ix] > upper):
+                continue
+            lookup[ix] = band
+            break
+
+    return boundaries, lookup
+
+
+def add_age_bands(df, bands):
+    """Add the age band of each patient, from the given bands."""
+
+    boundaries, lookup = get_age_band_lookup(tuple(bands))
+    df["age_band"] = lookup[np.searchsorted(boundaries, df["age"].values, side="right")]
+    assert df["age_band"].all()
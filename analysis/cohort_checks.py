@@ -1,23 +1,52 @@
 import os
 import pandas as pd
-from transform_fast import load_raw_cohort
+from cohort_store import load_checks
+from transform_fast import parse_date_columns, str_dtypes
 import csv
 
 input_path="output/input.csv"
+cohort_path="output/cohort"
 output_path="output/cohort_checks.csv"
 backend = os.getenv("OPENSAFELY_BACKEND", "expectations")
 
-def load_raw_cohort(input_path):
+def get_date_fieldnames(input_path):
     with open(input_path) as f:
         reader = csv.reader(f)
         fieldnames = next(reader)
 
-    date_fieldnames = [fn for fn in fieldnames if fn.endswith("_dat")]
-    raw_cohort = pd.read_csv(input_path, parse_dates=date_fieldnames, usecols=date_fieldnames)
-    return raw_cohort
+    return [fn for fn in fieldnames if fn.endswith("_dat")]
 
-raw_cohort = load_raw_cohort(input_path)
+def load_raw_cohort(input_path, date_fieldnames):
+    raw_cohort = pd.read_csv(input_path, usecols=date_fieldnames, dtype=str_dtypes(date_fieldnames))
+    return parse_date_columns(raw_cohort, date_fieldnames, {})
 
-checks = raw_cohort.agg({"max","min"}).transpose()
+def get_checks_from_transform(cohort_path):
+    """Return the earliest and latest value of each date column, as gathered by the
+    transform (see data_checks.py), or None if the transform did not gather them."""
+
+    checks = load_checks(cohort_path)
+    if checks is None:
+        return None
+
+    dates = checks["dates"]
+    return pd.DataFrame(
+        {
+            "max": [dates[fn]["max"] for fn in dates],
+            "min": [dates[fn]["min"] for fn in dates],
+        },
+        index=list(dates),
+    )
+
+
+date_fieldnames = get_date_fieldnames(input_path)
+checks = get_checks_from_transform(cohort_path)
+
+# The transform only checks the date columns that it reads, so any others (or all of
+# them, if the transform gathered no checks) are checked here
+unchecked = [fn for fn in date_fieldnames if checks is None or fn not in checks.index]
+if unchecked:
+    raw_cohort = load_raw_cohort(input_path, unchecked)
+    checks = pd.concat([checks, raw_cohort.agg(["max", "min"]).transpose()])
+    checks = checks.loc[date_fieldnames]
 
 checks.to_csv(f"{output_path}")
@@ -5,16 +5,41 @@ import os
 import pandas as pd
 import numpy as np
 
-input_path="output/cohort.pickle"
+from cohort_store import load_checks, load_cohort
+from comparisons import lt, notnull
+
+input_path="output/cohort"
 output_path="output/cohort_pickle_checks.csv"
 backend = os.getenv("OPENSAFELY_BACKEND", "expectations")
 
-cohort = pd.read_pickle(input_path)
+def count_declines(input_path):
+    """Return the number of patients with a decline whose first decline date is on
+    or after (0), or before (1), the start of the campaign.
+
+    The counts are taken from the checks gathered by the transform (see
+    data_checks.py) if there are any, and otherwise from the cohort.
+    """
+
+    transform_checks = load_checks(input_path)
+    if transform_checks is not None:
+        declines = transform_checks["declines"]
+        counts = pd.Series(
+            [declines["during_campaign"], declines["before_campaign"]],
+            index=pd.Index([0, 1], name="decline date incorrect"),
+            name="sex",
+        )
+        # As with groupby, values with no patients are left out
+        return counts[counts > 0]
+
+    cohort = load_cohort(input_path, ["decl_first_dat", "sex"], compact_dates=True)
+
+    cohort = cohort.loc[notnull(cohort["decl_first_dat"])]
+    cohort["decline date incorrect"] = np.where(lt(cohort["decl_first_dat"], "2020-12-08"), 1, 0)
+
+    return cohort.groupby(["decline date incorrect"])["sex"].count()
 
-cohort = cohort.loc[pd.notnull(cohort["decl_first_dat"])]
-cohort["decline date incorrect"] = np.where(cohort["decl_first_dat"] < "2020-12-08", 1, 0)
 
-checks = cohort.groupby(["decline date incorrect"])["sex"].count()
+checks = count_declines(input_path)
 checks = 100*checks/checks.sum()
 print (checks)
 
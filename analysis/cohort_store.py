@@ -0,0 +1,246 @@
+"""Read and write the cohort as a directory with one file per column.
+
+Downstream actions typically need only a handful of the cohort's columns, so rather
+than pickling the whole dataframe, we save each column as a .npy file, and record
+the name and dtype of each column in a manifest (schema.json).  Readers can then
+load just the columns they need.  Columns are memory mapped, so only the files that
+are asked for are read from disk.
+
+Columns of strings (such as sex) cannot be memory mapped, so they are stored as
+integer codes, with the distinct values recorded in the manifest.
+
+Date columns can optionally be stored, and loaded, as day offsets (see
+day_offsets.py), which take a quarter or a half of the space of datetimes.
+
+Boolean group columns can optionally be stored packed into bits, in a single matrix
+with one row per group (see group_bits.py).  They are unpacked when loaded with
+load_cohort, and load_group_bits returns them still packed.
+
+Alongside the cohort, write_attrition records how many records were excluded by
+each of the exclusion criteria, and write_checks records the data-quality checks
+gathered by the transform (see data_checks.py).
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from day_offsets import epoch, from_day_offsets, to_day_offsets
+from group_bits import pack_groups, unpack
+
+manifest_filename = "schema.json"
+index_filename = "_index.npy"
+groups_filename = "_groups.npy"
+attrition_filename = "attrition.csv"
+checks_filename = "checks.json"
+
+
+def write_cohort(cohort, path, compact_dates=False, packed_groups=False):
+    """Write the cohort to the directory at `path`.
+
+    If `compact_dates` is True, date columns are stored as day offsets.  If
+    `packed_groups` is True, boolean columns whose names end with "_group" are
+    stored packed into bits.
+    """
+
+    os.makedirs(path, exist_ok=True)
+
+    groups = []
+    if packed_groups:
+        groups = [
+            col
+            for col in cohort.columns
+            if col.endswith("_group") and cohort[col].dtype == bool
+        ]
+        np.save(os.path.join(path, groups_filename), pack_groups(cohort, groups))
+
+    columns = []
+    for col in cohort.columns:
+        values = cohort[col].values
+        column = {"name": col, "dtype": str(values.dtype), "file": f"{col}.npy"}
+
+        if col in groups:
+            column["file"] = groups_filename
+            column["encoding"] = "packed_bits"
+            column["row"] = groups.index(col)
+            columns.append(column)
+            continue
+
+        if values.dtype == object:
+            codes, categories = pd.factorize(values)
+            values = codes.astype(np.int32)
+            column["categories"] = categories.tolist()
+
+        elif compact_dates and values.dtype.kind == "M":
+            values = to_day_offsets(values)
+            column["encoding"] = "day_offsets"
+            column["epoch"] = str(epoch)
+
+        np.save(os.path.join(path, column["file"]), values)
+        columns.append(column)
+
+    np.save(os.path.join(path, index_filename), cohort.index.values)
+
+    manifest = {"nrows": len(cohort), "index": index_filename, "columns": columns}
+    with open(os.path.join(path, manifest_filename), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def load_cohort(path, columns=None, compact_dates=False):
+    """Load the cohort stored at `path`.
+
+    If `columns` is given, only those columns are loaded, in the order given.  If
+    `compact_dates` is True, date columns are returned as day offsets, and otherwise
+    as datetimes, however they were stored.
+    """
+
+    manifest = load_manifest(path)
+    schema = {column["name"]: column for column in manifest["columns"]}
+
+    if columns is None:
+        columns = list(schema)
+
+    missing = [col for col in columns if col not in schema]
+    if missing:
+        raise KeyError(f"Columns not in cohort at {path}: {missing}")
+
+    index = load_array(path, manifest["index"])
+    data = {
+        col: load_column(path, schema[col], compact_dates, manifest["nrows"])
+        for col in columns
+    }
+    return pd.DataFrame(data, index=pd.Index(index), columns=columns)
+
+
+def load_group_bits(path, groups):
+    """Load the given boolean columns of the cohort stored at `path`, packed into a
+    matrix of bits with one row per group.
+
+    If the columns were not stored packed, they are packed as they are loaded.
+    """
+
+    manifest = load_manifest(path)
+    schema = {column["name"]: column for column in manifest["columns"]}
+
+    missing = [group for group in groups if group not in schema]
+    if missing:
+        raise KeyError(f"Columns not in cohort at {path}: {missing}")
+
+    if all(schema[group].get("encoding") == "packed_bits" for group in groups):
+        bits = load_array(path, groups_filename)
+        return bits[[schema[group]["row"] for group in groups]]
+
+    return pack_groups(load_cohort(path, groups), groups)
+
+
+def load_manifest(path):
+    with open(os.path.join(path, manifest_filename)) as f:
+        return json.load(f)
+
+
+def record_source(path, source):
+    """Record in the manifest a key identifying what the cohort was built from."""
+
+    manifest = load_manifest(path)
+    manifest["source"] = source
+    with open(os.path.join(path, manifest_filename), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def get_source(path):
+    """Return the key recorded by record_source, or None if there is no cohort at
+    `path` or no key was recorded."""
+
+    if not os.path.exists(os.path.join(path, manifest_filename)):
+        return None
+    return load_manifest(path).get("source")
+
+
+def write_attrition(path, attrition):
+    """Write a table of the records excluded from the cohort stored at `path`.
+
+    `attrition` maps "records" to the number of records in the input, and each
+    exclusion criterion, in the order in which they were applied, to the number of
+    records that it excluded.
+    """
+
+    rows = []
+    remaining = attrition["records"]
+    for criterion, excluded in attrition.items():
+        if criterion == "records":
+            continue
+        rows.append([criterion, remaining, excluded, remaining - excluded])
+        remaining -= excluded
+
+    table = pd.DataFrame(
+        rows, columns=["criterion", "records_before", "excluded", "records_after"]
+    )
+    table.to_csv(os.path.join(path, attrition_filename), index=False)
+
+
+def write_checks(path, checks):
+    """Write the data-quality checks gathered while transforming the cohort stored at
+    `path`, or if `checks` is None, remove any that were written before."""
+
+    checks_path = os.path.join(path, checks_filename)
+    if checks is None:
+        if os.path.exists(checks_path):
+            os.remove(checks_path)
+        return
+
+    dates = {
+        col: dict(stats, min=format_date(stats["min"]), max=format_date(stats["max"]))
+        for col, stats in checks["dates"].items()
+    }
+    with open(checks_path, "w") as f:
+        json.dump(dict(checks, dates=dates), f, indent=2)
+
+
+def format_date(value):
+    return None if value is None else str(pd.Timestamp(value))
+
+
+def load_checks(path):
+    """Return the data-quality checks written by write_checks, with the earliest and
+    latest dates as Timestamps, or None if there are none."""
+
+    checks_path = os.path.join(path, checks_filename)
+    if not os.path.exists(checks_path):
+        return None
+
+    with open(checks_path) as f:
+        checks = json.load(f)
+    for stats in checks["dates"].values():
+        for key in ["min", "max"]:
+            stats[key] = pd.NaT if stats[key] is None else pd.Timestamp(stats[key])
+    return checks
+
+
+def load_column(path, column, compact_dates, nrows):
+    values = load_array(path, column["file"])
+
+    if column.get("encoding") == "packed_bits":
+        return unpack(values[column["row"]], nrows)
+
+    if "categories" in column:
+        categories = np.array(column["categories"] + [np.nan], dtype=object)
+        # Missing values have code -1, which picks out the trailing NaN
+        return categories[values]
+
+    if column.get("encoding") == "day_offsets":
+        assert column["epoch"] == str(epoch), column["epoch"]
+        if not compact_dates:
+            return from_day_offsets(values)
+
+    elif compact_dates and values.dtype.kind == "M":
+        return to_day_offsets(values)
+
+    return values
+
+
+def load_array(path, filename):
+    # Copy-on-write, so that callers can modify the columns they load without
+    # affecting the files on disk.
+    return np.load(os.path.join(path, filename), mmap_mode="c")
@@ -0,0 +1,332 @@
+"""Run the fast and slow transforms on the same input, and report whether they agree.
+
+The two engines are meant to produce the same cohort, but only one of them runs on
+each backend, so a divergence could otherwise go unnoticed.  For each scale (a
+number of rows from the start of the input, or "all"), we run both engines, record
+how long each took and its peak memory, and compare the cohorts, matching rows by
+patient_id.
+
+The report is written as JSON, so that it can be tracked across releases.  It
+includes a few example patient_ids for any mismatched column, so it should only be
+run against dummy data.
+
+With --previous-input, the report also says, for each engine, whether updating the
+cohort built from the previous extract (see transform_incremental.py) gives the same
+cohort as transforming the whole of the input, including the dtype of each column.
+It also checks an update that only removes a patient, whose practice is blanked in
+the previous extract, so that the practice column should become int64 again (see
+transform_incremental.get_dtypes).
+
+Peak memory is measured with tracemalloc, in a second run of each engine so that
+tracing does not affect the timings.  It covers allocations made in this process
+only, so does not include the workers used by the slow engine when --workers is
+greater than 1.
+
+Usage:
+
+    python analysis/compare_transforms.py output/input.csv --scales 1000,10000,all
+    python analysis/compare_transforms.py output/input.csv --previous-input output/previous_input.csv
+"""
+
+import argparse
+import csv
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import transform_fast, transform_incremental, transform_slow
+from cohort_store import load_cohort
+
+n_examples = 5
+
+
+def run(
+    input_path="output/input.csv",
+    output_path="output/transform_comparison.json",
+    scales=("all",),
+    chunksize=None,
+    workers=1,
+    previous_input_path=None,
+):
+    engines = {
+        "fast": lambda path: transform_fast.transform_file(path, chunksize),
+        "slow": lambda path: transform_slow.transform_file(path, workers),
+    }
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for scale in scales:
+            path = get_sample(input_path, scale, tmpdir)
+            results.append(compare_at_scale(engines, path, scale))
+
+        incremental = {}
+        incremental_deletion = {}
+        if previous_input_path:
+            deletion_paths = get_deletion_case(input_path, tmpdir)
+            for engine in engines:
+                incremental[engine] = compare_incremental(
+                    engine, input_path, previous_input_path, chunksize, workers, tmpdir
+                )
+                incremental_deletion[engine] = compare_incremental(
+                    engine, *deletion_paths, chunksize, workers, tmpdir
+                )
+
+    report = {
+        "input_path": input_path,
+        "chunksize": chunksize,
+        "workers": workers,
+        "versions": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+        },
+        "equal": all(result["comparison"]["equal"] for result in results)
+        and all(comparison["equal"] for comparison in incremental.values())
+        and all(comparison["equal"] for comparison in incremental_deletion.values()),
+        "scales": results,
+    }
+    if previous_input_path:
+        report["previous_input_path"] = previous_input_path
+        report["incremental"] = incremental
+        report["incremental_deletion"] = incremental_deletion
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    return report
+
+
+def get_sample(input_path, scale, tmpdir):
+    """Return the path of a file containing the header and the first `scale` rows of
+    the input, or the input itself if `scale` is "all".
+
+    As in transform_slow.get_shards, this assumes that no field contains a newline.
+    """
+
+    if scale == "all":
+        return input_path
+
+    sample_path = os.path.join(tmpdir, f"input_{scale}.csv")
+    with open(input_path) as f_in, open(sample_path, "w") as f_out:
+        for ix, line in enumerate(f_in):
+            if ix > scale:
+                break
+            f_out.write(line)
+    return sample_path
+
+
+def compare_at_scale(engines, path, scale):
+    cohorts = {}
+    engine_results = {}
+    for name, engine in engines.items():
+        cohort, seconds = timed(engine, path)
+        engine_results[name] = {
+            "rows": len(cohort),
+            "columns": len(cohort.columns),
+            "seconds": round(seconds, 3),
+            "peak_memory_bytes": peak_memory(engine, path),
+        }
+        cohorts[name] = cohort
+
+    with open(path) as f:
+        input_rows = sum(1 for line in f) - 1
+
+    return {
+        "scale": scale,
+        "input_rows": input_rows,
+        "engines": engine_results,
+        "comparison": compare_cohorts(cohorts["fast"], cohorts["slow"]),
+    }
+
+
+def get_deletion_case(input_path, tmpdir):
+    """Return the paths of a pair of extracts, where the second is the input, less
+    its first patient, and the first is the input with that patient's practice
+    blanked.
+
+    Unless the patient is excluded, or others have no practice, a full run of the
+    first has a float64 practice column and a full run of the second has int64, so
+    updating the cohort of
+    the first to the second checks that a column is narrowed when the patients who
+    widened it are removed, even though no patient is transformed.
+    """
+
+    paths = [os.path.join(tmpdir, f"deletion_{name}.csv") for name in ["new", "previous"]]
+    with open(input_path) as f_in, open(paths[0], "w") as f_new, open(
+        paths[1], "w"
+    ) as f_previous:
+        header = next(f_in)
+        f_new.write(header)
+        f_previous.write(header)
+
+        row = next(csv.reader([next(f_in)]))
+        row[next(csv.reader([header])).index("practice")] = ""
+        csv.writer(f_previous, lineterminator="\n").writerow(row)
+
+        for line in f_in:
+            f_new.write(line)
+            f_previous.write(line)
+    return paths
+
+
+def compare_incremental(engine, input_path, previous_input_path, chunksize, workers, tmpdir):
+    """Compare the cohort that `engine` gives for the input when updating the cohort
+    built from the previous extract with the cohort it gives when transforming the
+    whole of the input, as each is stored."""
+
+    paths = {
+        name: os.path.join(tmpdir, f"{engine}_{name}") for name in ["incremental", "full"]
+    }
+    options = {"chunksize": chunksize, "workers": workers}
+    transform_incremental.run(engine, previous_input_path, None, paths["incremental"], **options)
+    transformed = transform_incremental.run(
+        engine, input_path, previous_input_path, paths["incremental"], **options
+    )
+    transform_incremental.run(engine, input_path, None, paths["full"], **options)
+
+    comparison = compare_cohorts(
+        load_cohort(paths["incremental"]), load_cohort(paths["full"]), ("incremental", "full")
+    )
+    comparison["patients_transformed"] = transformed
+    return comparison
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def peak_memory(fn, *args):
+    tracemalloc.start()
+    try:
+        fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def compare_cohorts(fast, slow, names=("fast", "slow")):
+    """Return a description of the differences between two cohorts, naming them
+    after `names`."""
+
+    fast_name, slow_name = names
+    fast = fast.set_index("patient_id")
+    slow = slow.set_index("patient_id")
+
+    common_rows = fast.index.intersection(slow.index)
+    common_cols = [col for col in fast.columns if col in slow.columns]
+
+    comparison = {
+        f"rows_only_in_{fast_name}": len(fast.index.difference(slow.index)),
+        f"rows_only_in_{slow_name}": len(slow.index.difference(fast.index)),
+        f"columns_only_in_{fast_name}": [col for col in fast.columns if col not in slow.columns],
+        f"columns_only_in_{slow_name}": [col for col in slow.columns if col not in fast.columns],
+        "dtype_mismatches": {},
+        "value_mismatches": {},
+    }
+
+    fast = fast.loc[common_rows]
+    slow = slow.loc[common_rows]
+    mismatched_rows = pd.Series(False, index=common_rows)
+
+    for col in common_cols:
+        if fast[col].dtype != slow[col].dtype:
+            comparison["dtype_mismatches"][col] = {
+                fast_name: str(fast[col].dtype),
+                slow_name: str(slow[col].dtype),
+            }
+
+        mismatched = ~(
+            (fast[col] == slow[col]) | (fast[col].isnull() & slow[col].isnull())
+        )
+        if mismatched.any():
+            comparison["value_mismatches"][col] = {
+                "rows": int(mismatched.sum()),
+                "example_patient_ids": [
+                    str(patient_id)
+                    for patient_id in mismatched.index[mismatched][:n_examples]
+                ],
+            }
+            mismatched_rows |= mismatched
+
+    comparison["mismatched_rows"] = int(mismatched_rows.sum())
+    comparison["equal"] = not (
+        comparison[f"rows_only_in_{fast_name}"]
+        or comparison[f"rows_only_in_{slow_name}"]
+        or comparison[f"columns_only_in_{fast_name}"]
+        or comparison[f"columns_only_in_{slow_name}"]
+        or comparison["dtype_mismatches"]
+        or comparison["value_mismatches"]
+    )
+    return comparison
+
+
+def parse_scales(value):
+    return [scale if scale == "all" else int(scale) for scale in value.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_path")
+    parser.add_argument(
+        "--output",
+        default="output/transform_comparison.json",
+        help="Path of the JSON report",
+    )
+    parser.add_argument(
+        "--scales",
+        type=parse_scales,
+        default=["all"],
+        help="Comma-separated numbers of rows to compare at, or 'all' for every row",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        help="Read and transform the input in blocks of this many rows (fast engine)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes for the row-wise transform (slow engine)",
+    )
+    parser.add_argument(
+        "--previous-input",
+        dest="previous_input_path",
+        help="Also compare updating the cohort built from this extract with "
+        "transforming the whole input",
+    )
+    args = parser.parse_args()
+
+    report = run(
+        input_path=args.input_path,
+        output_path=args.output,
+        scales=args.scales,
+        chunksize=args.chunksize,
+        workers=args.workers,
+        previous_input_path=args.previous_input_path,
+    )
+    for result in report["scales"]:
+        print(
+            result["scale"],
+            {name: engine["seconds"] for name, engine in result["engines"].items()},
+            "equal" if result["comparison"]["equal"] else "DIFFERENT",
+        )
+    for case in ["incremental", "incremental_deletion"]:
+        for engine, comparison in report.get(case, {}).items():
+            print(
+                f"{case} ({engine})",
+                comparison["patients_transformed"],
+                "equal" if comparison["equal"] else "DIFFERENT",
+            )
+    sys.exit(0 if report["equal"] else 1)
@@ -30,20 +30,85 @@ And the patient should not be assigned to DIAB_GROUP if one of:
     * DIAB_DAT and DMRES_DAT are both null
 
 As such, we need the functions below, which handle NaN values correctly.
+
+The functions also accept date columns in the compact representation defined in
+day_offsets.py, where a null is represented by the smallest value of the column's
+integer type.  Since a null is then earlier than any date, gt and lt are plain
+integer comparisons, and gte and lte need only exclude the case where both sides are
+null.
+
+The right hand side may also be a date string (eg "2020-12-08").
 """
 
+import numpy as np
+
+from day_offsets import is_day_offsets, null_value, to_day_offset
+
 
 def gt(lhs, rhs):
-    return (lhs > rhs) | (lhs.notna() & rhs.isna())
+    lhs, rhs = as_comparable(lhs, rhs)
+    if is_day_offsets(lhs):
+        return lhs > rhs
+    return (lhs > rhs) | (notnull(lhs) & isnull(rhs))
 
 
 def gte(lhs, rhs):
-    return (lhs >= rhs) | (lhs.notna() & rhs.isna())
+    lhs, rhs = as_comparable(lhs, rhs)
+    if is_day_offsets(lhs):
+        return (lhs >= rhs) & notnull(lhs)
+    return (lhs >= rhs) | (notnull(lhs) & isnull(rhs))
 
 
 def lt(lhs, rhs):
-    return (lhs < rhs) | (lhs.isna() & rhs.notna())
+    lhs, rhs = as_comparable(lhs, rhs)
+    if is_day_offsets(lhs):
+        return lhs < rhs
+    return (lhs < rhs) | (isnull(lhs) & notnull(rhs))
 
 
 def lte(lhs, rhs):
-    return (lhs <= rhs) | (lhs.isna() & rhs.notna())
+    lhs, rhs = as_comparable(lhs, rhs)
+    if is_day_offsets(lhs):
+        return (lhs <= rhs) & notnull(rhs)
+    return (lhs <= rhs) | (isnull(lhs) & notnull(rhs))
+
+
+def isnull(s):
+    if np.isscalar(s):
+        return False
+    if is_day_offsets(s):
+        return s == null_value(s.dtype)
+    return s.isna()
+
+
+def notnull(s):
+    if np.isscalar(s):
+        return True
+    return ~isnull(s)
+
+
+def as_comparable(lhs, rhs):
+    """Return lhs and rhs in a form in which they can be compared.
+
+    If lhs holds day offsets, a date string on the right hand side is converted into
+    a day offset, and if the two sides have different integer types, both are
+    widened to the larger type, so that nulls in the narrower one stay below every
+    date.
+    """
+
+    if not is_day_offsets(lhs):
+        return lhs, rhs
+
+    if isinstance(rhs, str):
+        return lhs, to_day_offset(rhs)
+
+    if is_day_offsets(rhs) and lhs.dtype != rhs.dtype:
+        dtype = np.promote_types(lhs.dtype, rhs.dtype)
+        lhs = widen(lhs, dtype)
+        rhs = widen(rhs, dtype)
+
+    return lhs, rhs
+
+
+def widen(s, dtype):
+    return s.astype(dtype).mask(isnull(s), null_value(dtype))
@@ -1,32 +1,222 @@
 import os
+import numpy as np
 import pandas as pd
 
+from disclosure import redact, rounding
 from groups import groups
 
 
 def compute_uptake(cohort, event_col, stratification_col):
-    stratification_series = cohort[stratification_col]
-    stratification_vals = sorted(stratification_series.value_counts().index)
+    """Return the cumulative number of patients in each stratum with an event on or
+    before each day, from the earliest event to the latest, followed by a row with
+    the total number of patients in each stratum.  All counts are rounded down to a
+    multiple of 7.
+    """
 
-    event_dates = cohort[cohort[event_col].notnull()][event_col]
-    if event_dates.empty:
-        return
+    cube = build_uptake_cube(cohort, [event_col], None, [stratification_col])
+    uptake, _ = slice_uptake_cube(cube, event_col, None, stratification_col)
+    return uptake
 
-    earliest, latest = min(event_dates), max(event_dates)
-    index = [str(date.date()) for date in pd.date_range(earliest, latest)]
 
-    uptake = pd.DataFrame(index=index)
+def build_uptake_cube(cohort, event_cols, wave_col, stratification_cols):
+    """Count the patients with each event on each day, by wave and by stratum, for
+    several event and stratification columns at once.
 
-    for stratification_val in stratification_vals:
-        filtered = cohort[stratification_series == stratification_val]
-        series = pd.Series(0, index=index)
-        for date, count in filtered[event_col].value_counts().iteritems():
-            series[str(date.date())] = count
-        uptake[stratification_val] = series.cumsum()
+    Each patient is given a wave code, a stratum code for each stratification column,
+    and a day offset for each event, once.  The strata of all the columns are laid
+    along a single axis, so that the counts are held in a cube with one cell per
+    event, wave, stratum and day, which is filled with one bincount per event and
+    stratification column.
 
-    uptake.loc["total"] = stratification_series.value_counts()
-    uptake.fillna(0, inplace=True)
-    return ((uptake // 7) * 7).astype(int)
+    If `wave_col` is None, all patients are in a single wave.  Use slice_uptake_cube
+    to get the uptake for one event, wave and stratification column.  Coarser waves
+    and strata can be added with roll_up_waves and roll_up_strata.
+    """
+
+    if wave_col is None:
+        waves = [None]
+        wave_codes = np.zeros(len(cohort), dtype=np.intp)
+    else:
+        # Waves and strata are sorted, and patients with no value have code -1
+        wave_codes, waves = pd.factorize(cohort[wave_col], sort=True)
+        waves = list(waves)
+    n_waves = len(waves)
+
+    # strata maps each stratification column to the position of its first stratum
+    # on the stratum axis, and its values
+    strata = {}
+    stratum_codes = {}
+    n_strata = 0
+    for col in stratification_cols:
+        codes, values = pd.factorize(cohort[col], sort=True)
+        strata[col] = (n_strata, values)
+        stratum_codes[col] = codes
+        n_strata += len(values)
+
+    # The rows of the patients with each event
+    event_rows = {}
+    for event_col in event_cols:
+        event_rows[event_col] = np.flatnonzero(
+            ~pd.isnull(cohort[event_col].values) & (wave_codes >= 0)
+        )
+    event_days = {
+        event_col: cohort[event_col].values[rows].astype("datetime64[D]")
+        for event_col, rows in event_rows.items()
+    }
+
+    days = []
+    n_days = 0
+    dated = [dates for dates in event_days.values() if len(dates)]
+    if dated:
+        earliest = min(dates.min() for dates in dated)
+        n_days = int((max(dates.max() for dates in dated) - earliest).astype(np.int64)) + 1
+        days = np.arange(earliest, earliest + n_days).astype(str).tolist()
+
+    counts = np.zeros((len(event_cols), n_waves, n_strata, n_days), dtype=np.int64)
+    # The number of patients in each wave with each event on each day, whatever
+    # their strata, which gives the range of days for each wave
+    wave_counts = np.zeros((len(event_cols), n_waves, n_days), dtype=np.int64)
+
+    for ix, event_col in enumerate(event_cols):
+        rows = event_rows[event_col]
+        if not len(rows):
+            continue
+        day_offsets = (event_days[event_col] - earliest).astype(np.int64)
+        event_wave_codes = wave_codes[rows]
+
+        wave_counts[ix] = bincount_cells(
+            [(event_wave_codes, n_waves), (day_offsets, n_days)]
+        )
+
+        for col in stratification_cols:
+            offset, values = strata[col]
+            codes = stratum_codes[col][rows]
+            in_stratum = codes >= 0
+            counts[ix, :, offset : offset + len(values)] = bincount_cells(
+                [
+                    (event_wave_codes[in_stratum], n_waves),
+                    (codes[in_stratum], len(values)),
+                    (day_offsets[in_stratum], n_days),
+                ]
+            )
+
+    # The number of patients in each wave and stratum
+    totals = np.zeros((n_waves, n_strata), dtype=np.int64)
+    for col in stratification_cols:
+        offset, values = strata[col]
+        codes = stratum_codes[col]
+        in_stratum = (codes >= 0) & (wave_codes >= 0)
+        totals[:, offset : offset + len(values)] = bincount_cells(
+            [(wave_codes[in_stratum], n_waves), (codes[in_stratum], len(values))]
+        )
+
+    return {
+        "event_cols": list(event_cols),
+        "waves": waves,
+        "strata": strata,
+        "days": days,
+        "counts": counts,
+        "wave_counts": wave_counts,
+        "totals": totals,
+    }
+
+
+def roll_up_waves(cube, groupings):
+    """Return a cube whose waves are unions of the waves of `cube`, where `groupings`
+    maps each new wave to a list of the waves that it contains.
+
+    The counts are summed from those of the waves in each union, without looking at
+    the cohort again.  Unions may overlap.
+    """
+
+    waves, membership = get_membership(cube["waves"], groupings)
+    return dict(
+        cube,
+        waves=waves,
+        counts=np.einsum("nw,ewsd->ensd", membership, cube["counts"]),
+        wave_counts=np.einsum("nw,ewd->end", membership, cube["wave_counts"]),
+        totals=membership @ cube["totals"],
+    )
+
+
+def roll_up_strata(cube, stratification_col, coarse_col, groupings):
+    """Return a cube with strata for `coarse_col` added, where `groupings` maps each
+    value of `coarse_col` to a list of the values of `stratification_col` that it
+    contains.
+
+    As with roll_up_waves, the counts are summed, and unions may overlap.
+    """
+
+    offset, values = cube["strata"][stratification_col]
+    coarse_values, membership = get_membership(values, groupings)
+    fine = slice(offset, offset + len(values))
+
+    counts = np.einsum("cs,ewsd->ewcd", membership, cube["counts"][:, :, fine])
+    totals = cube["totals"][:, fine] @ membership.T
+    strata = dict(cube["strata"])
+    strata[coarse_col] = (cube["totals"].shape[1], pd.Index(coarse_values))
+
+    return dict(
+        cube,
+        strata=strata,
+        counts=np.concatenate([cube["counts"], counts], axis=2),
+        totals=np.concatenate([cube["totals"], totals], axis=1),
+    )
+
+
+def get_membership(values, groupings):
+    """Return the sorted keys of `groupings`, and a matrix with a row for each key and
+    a column for each of `values`, which is 1 where the value is in the key's list."""
+
+    keys = sorted(groupings)
+    membership = np.array(
+        [[value in groupings[key] for value in values] for key in keys], dtype=np.int64
+    ).reshape(len(keys), len(values))
+    return keys, membership
+
+
+def bincount_cells(axes):
+    """Count the occurrences of each combination of codes, where `axes` is a list of
+    (codes, size) pairs, and return an array with one dimension per axis."""
+
+    cells = np.zeros(len(axes[0][0]), dtype=np.int64)
+    for codes, size in axes:
+        cells *= size
+        cells += codes
+    shape = [size for _, size in axes]
+    return np.bincount(cells, minlength=np.prod(shape, dtype=np.int64)).reshape(shape)
+
+
+def slice_uptake_cube(cube, event_col, wave, stratification_col):
+    """Return what compute_uptake would return for the patients in `wave` (or for
+    all patients, if the cube was built without a wave column), and a frame of the
+    same shape which is True where a count was changed by rounding, or (None, None)
+    if none of them has the event."""
+
+    if wave not in cube["waves"]:
+        return None, None
+    event_ix = cube["event_cols"].index(event_col)
+    wave_ix = cube["waves"].index(wave)
+
+    event_days = np.flatnonzero(cube["wave_counts"][event_ix, wave_ix])
+    if not len(event_days):
+        return None, None
+    first, last = event_days[0], event_days[-1] + 1
+
+    offset, values = cube["strata"][stratification_col]
+    totals = cube["totals"][wave_ix, offset : offset + len(values)]
+    # Only the strata with patients in the wave are included
+    present = totals > 0
+    counts = cube["counts"][event_ix, wave_ix, offset : offset + len(values)]
+    counts = counts[present, first:last]
+
+    uptake = np.vstack([counts.cumsum(axis=1).T, totals[present]])
+    uptake, modified = redact(uptake, rounding)
+    index = cube["days"][first:last] + ["total"]
+    return (
+        pd.DataFrame(uptake, index=index, columns=values[present]),
+        pd.DataFrame(modified, index=index, columns=values[present]),
+    )
 
 
 if __name__ == "__main__":
@@ -1,9 +1,24 @@
+import argparse
 import os
-import pandas as pd
 
-from compute_uptake import compute_uptake
+from cohort_store import load_cohort
+from disclosure import record_redactions
+from compute_uptake import (
+    build_uptake_cube,
+    roll_up_strata,
+    roll_up_waves,
+    slice_uptake_cube,
+)
 from groups import at_risk_groups
-from custom_operations import invert_df
+from uptake_incremental import (
+    default_state_path,
+    load_state,
+    remove_state,
+    save_state,
+    write_uptake,
+)
+from uptake_sets import complement
+from waves import wave2_waves
 
 
 demographic_cols = [
@@ -18,65 +33,166 @@ other_cols = ["preg_group", "sevment_group", "learndis_group", "immuno_group"]
 
 cols = demographic_cols  + other_cols #+ at_risk_cols
 
+event_cols = [
+    ("vacc1_dat", "dose_1"),
+    ("vacc_any_record_dat", "any_vaccine_record"),
+    ("decl_dat", "declined"),
+    #("cov2not_dat", "vaccine_not_done"),
+    #("cov1decl_acc_dat", "declined_accepted"),
+]
+
+
+def run(
+    input_path="output/cohort",
+    output_dir="output",
+    incremental=False,
+    state_path=default_state_path,
+):
+    """Write the cumulative coverage CSVs.
+
+    If `incremental` is True, only the CSVs that have changed since the previous
+    incremental run are written, and of those, only the rows for new days are written
+    where the earlier rows are unchanged (see uptake_incremental.py).
+    """
 
-def run(input_path="output/cohort.pickle", output_dir="output"):
     backend = os.getenv("OPENSAFELY_BACKEND", "expectations")
     base_path = f"{output_dir}/{backend}/cumulative_coverage"
-    cohort = pd.read_pickle(input_path)
-
-    for event_col, key in [
-        ("vacc1_dat", "dose_1"),
-        ("vacc_any_record_dat", "any_vaccine_record"),
-        ("decl_dat", "declined"),
-        #("cov2not_dat", "vaccine_not_done"),
-	    #("cov1decl_acc_dat", "declined_accepted"),
-    ]:
+    cohort = load_cohort(
+        input_path, [event_col for event_col, _ in event_cols] + ["wave"] + cols
+    )
+
+    # The counts for every event, wave and column are built up front, in one cube for
+    # all patients and one for patients by wave, and each CSV is a slice of a cube.
+    # Each combined wave (wave2) is a union of waves, so its counts are summed from
+    # the counts by wave, rather than counted again.
+    all_event_cols = [event_col for event_col, _ in event_cols]
+    cube_all = build_uptake_cube(cohort, all_event_cols, None, ["wave"])
+    cube_all = roll_up_strata(cube_all, "wave", "wave2", wave2_waves)
+    cube = build_uptake_cube(cohort, all_event_cols, "wave", cols)
+    cube2 = roll_up_waves(cube, wave2_waves)
+    cubes = {"all": cube_all, "by_wave": cube, "by_wave2": cube2}
+
+    # The cubes saved by the previous run, from which the tables that it wrote are
+    # sliced, or None for each cube if there was no previous run
+    previous_cubes = None
+    if incremental:
+        previous_cubes = load_state(state_path, all_event_cols, cols)
+    else:
+        remove_state(state_path)
+    if previous_cubes is None:
+        previous_cubes = dict.fromkeys(cubes)
+
+    for event_col, key in event_cols:
 
         # Compute uptake by wave
         dir_path = f"{base_path}/all/{key}"
         os.makedirs(dir_path, exist_ok=True)
-        uptake = compute_uptake(cohort, event_col, "wave")
-        uptake.to_csv(f"{dir_path}/all_{key}_by_group.csv")
+        uptake, modified = slice_uptake_cube(cube_all, event_col, None, "wave")
+        previous = slice_previous(previous_cubes["all"], event_col, None, "wave")
+        write_uptake(uptake, previous, f"{dir_path}/all_{key}_by_group.csv")
+        record_redactions(f"{dir_path}/all_{key}_by_group.csv", modified)
 
         # Compute uptake by broader waves (1-3)
-        uptake_w2 = compute_uptake(cohort, event_col, "wave2")
-        uptake_w2.to_csv(f"{dir_path}/all_{key}_by_group2.csv")
+        uptake_w2, modified_w2 = slice_uptake_cube(cube_all, event_col, None, "wave2")
+        previous_w2 = slice_previous(previous_cubes["all"], event_col, None, "wave2")
+        write_uptake(uptake_w2, previous_w2, f"{dir_path}/all_{key}_by_group2.csv")
+        record_redactions(f"{dir_path}/all_{key}_by_group2.csv", modified_w2)
 
         # for "any vaccine record" calculate the inverse ie. no of patients with NO vaccine related record
         if event_col == "vacc_any_record_dat":
-            uptake_inv = invert_df(uptake)
-            uptake2_inv = invert_df(uptake_w2)
             out_path = f"{base_path}/all/unreached"
             os.makedirs(out_path, exist_ok=True)
-            uptake_inv.to_csv(f"{out_path}/all_unreached_by_group.csv")
-            uptake2_inv.to_csv(f"{out_path}/all_unreached_by_group2.csv")
+            write_uptake(
+                complement(uptake),
+                complement_or_none(previous),
+                f"{out_path}/all_unreached_by_group.csv",
+            )
+            record_redactions(
+                f"{out_path}/all_unreached_by_group.csv", complement_modified(modified)
+            )
+            write_uptake(
+                complement(uptake_w2),
+                complement_or_none(previous_w2),
+                f"{out_path}/all_unreached_by_group2.csv",
+            )
+            record_redactions(
+                f"{out_path}/all_unreached_by_group2.csv", complement_modified(modified_w2)
+            )
 
         # For each wave, compute uptake by column
         for wave in range(1, 9 + 1):
             group_type=""
-            compute_uptake_for_wave(cohort, wave, cols, event_col, key, group_type, base_path, dir_path)
+            compute_uptake_for_wave(cube, wave, cols, event_col, key, group_type, base_path, dir_path, previous_cubes["by_wave"])
         for wave2 in range(1, 3 + 1):
             group_type = "2"
-            compute_uptake_for_wave(cohort, wave2, cols, event_col, key, group_type, base_path, dir_path)
+            compute_uptake_for_wave(cube2, wave2, cols, event_col, key, group_type, base_path, dir_path, previous_cubes["by_wave2"])
+
+    if incremental:
+        save_state(state_path, all_event_cols, cols, cubes)
 
 
-def compute_uptake_for_wave(cohort, wave, cols, event_col, key, group_type, base_path, dir_path):
+def compute_uptake_for_wave(cube, wave, cols, event_col, key, group_type, base_path, dir_path, previous_cube=None):
     os.makedirs(dir_path, exist_ok=True)
-    wave_cohort = cohort[cohort[f"wave{group_type}"] == wave]
 
     for col in cols:
         dir_path = f"{base_path}/group{group_type}_{wave}/{key}"
         os.makedirs(dir_path, exist_ok=True)
-        uptake = compute_uptake(wave_cohort, event_col, col)
+        uptake, modified = slice_uptake_cube(cube, event_col, wave, col)
         if uptake is None:
             continue
-        uptake.to_csv(f"{dir_path}/group_{wave}_{key}_by_{col}.csv")
+        previous = slice_previous(previous_cube, event_col, wave, col)
+        write_uptake(uptake, previous, f"{dir_path}/group_{wave}_{key}_by_{col}.csv")
+        record_redactions(f"{dir_path}/group_{wave}_{key}_by_{col}.csv", modified)
 
         if event_col == "vacc_any_record_dat":
-            uptake2 = invert_df(uptake)
             out_path = f"{base_path}/group{group_type}_{wave}/unreached"
             os.makedirs(out_path, exist_ok=True)
-            uptake2.to_csv(f"{out_path}/group_{wave}_unreached_by_{col}.csv")
+            write_uptake(
+                complement(uptake),
+                complement_or_none(previous),
+                f"{out_path}/group_{wave}_unreached_by_{col}.csv",
+            )
+            record_redactions(
+                f"{out_path}/group_{wave}_unreached_by_{col}.csv", complement_modified(modified)
+            )
+
+
+def slice_previous(cube, event_col, wave, col):
+    """As slice_uptake_cube, for a cube saved by the previous run, which may be
+    None."""
+
+    if cube is None:
+        return
+    uptake, _ = slice_uptake_cube(cube, event_col, wave, col)
+    return uptake
+
+
+def complement_modified(modified):
+    """Return which counts of the complement of an uptake table were changed by
+    rounding, given which counts of the table were: each is the stratum's total
+    less a count, so is changed if either of them was."""
+
+    return modified | modified.loc["total"]
+
+
+def complement_or_none(uptake):
+    if uptake is None:
+        return
+    return complement(uptake)
+
 
 if __name__ == "__main__":
-    run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Update the CSVs written by the previous incremental run, writing only "
+        "what has changed, and save the state for the next run (local runs only)",
+    )
+    parser.add_argument(
+        "--state-path",
+        default=default_state_path,
+        help=f"Where the state for incremental runs is kept (default: {default_state_path})",
+    )
+    args = parser.parse_args()
+    run(incremental=args.incremental, state_path=args.state_path)
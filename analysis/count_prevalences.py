@@ -1,36 +1,43 @@
 import os
 import pandas as pd
 
+from cohort_store import load_cohort, load_group_bits
+from disclosure import record_redactions, redact_table, rounding
+from group_bits import count_by_value, pack_by_value, popcount
 
-input_path="output/cohort.pickle"
+
+input_path="output/cohort"
 backend = os.getenv("OPENSAFELY_BACKEND", "expectations")
 output_path = "output/" + backend + "/tables"
 os.makedirs(output_path, exist_ok=True)
 
-cohort = pd.read_pickle(input_path)
+cols = ["vacc_group", "decline_group","decline_total_group",
+        "other_reason_group", "declined_accepted_group", "vaccinated_and_declined_group",
+        "preg_group", "sevment_group", "learndis_group", "immuno_group"]
+
+cohort = load_cohort(input_path, ["patient_id", "wave", "wave2", "high_level_ethnicity"])
+
+# Membership of the groups in cols, packed into bits, with one row per group
+group_bits = load_group_bits(input_path, cols)
 
 
-def count_prevalences(cohort):
+def count_prevalences(cohort, group_bits):
 
     for group_type in ["","2"]:
         
         pop_total = cohort["patient_id"].count()
         
-        cols = ["vacc_group", "decline_group","decline_total_group",
-        "other_reason_group", "declined_accepted_group", "vaccinated_and_declined_group",
-        "preg_group", "sevment_group", "learndis_group", "immuno_group"]
-        
         prevalences = pd.DataFrame(
             {"total": cohort.groupby([f"wave{group_type}"])["patient_id"].count()}
         )
 
         
-        for col in cols:
-            prevalences[col] = (
-                cohort[cohort[col]].groupby([f"wave{group_type}"])["patient_id"].count()
-            )
+        # Count the members of each group in each wave from the packed bits
+        wave_bits = pack_by_value(cohort[f"wave{group_type}"])
+        for col, bits in zip(cols, group_bits):
+            prevalences[col] = pd.Series(count_by_value(bits, wave_bits))
 
-        totals = cohort[cols].sum()
+        totals = pd.Series([popcount(bits) for bits in group_bits], index=cols)
         totals["total"] = pop_total
         totals = totals.rename("total")
         prevalences = prevalences.append(totals)
@@ -50,12 +57,14 @@ def count_prevalences(cohort):
             prevalences[f"ethnicity_{high_level_ethnicity_category}"].loc["total"] = eth_total
 
         prevalences.fillna(0, inplace=True)
-        prevalences = ((prevalences // 7) * 7).astype(int)
+        prevalences, modified = redact_table(prevalences, rounding)
+        prevalences = prevalences.astype(int)
 
         for c in prevalences.columns:
             prevalences[f"{c}_percent"] = (100*prevalences[c]/prevalences["total"]).round(1)
         prevalences.fillna(0, inplace=True)
         prevalences.to_csv(output_path+f"/prevalences{group_type}.csv")
+        record_redactions(output_path+f"/prevalences{group_type}.csv", modified)
 
 
-count_prevalences(cohort)
+count_prevalences(cohort, group_bits)
@@ -1,4 +1,4 @@
-''' This module generates charts from cohort.pickle rather than from the cumulative csvs.
+''' This module generates charts from the cohort rather than from the cumulative csvs.
 ''' 
 
 import os
@@ -6,6 +6,8 @@ import pandas as pd
 import matplotlib.pyplot as plt
 from plot_practice_charts import *
 from ethnicities import high_level_ethnicities
+from cohort_store import load_cohort
+from disclosure import low_number_suppression, record_redactions, redact_table
 
 wave_column_headings = {
     "total": "All",
@@ -51,11 +53,11 @@ def compute_uptake_percent(uptake):#, labels):
     return uptake_pc
 
 
-def practice_variation(input_path="output/cohort.pickle", output_dir=out_path):
+def practice_variation(input_path="output/cohort", output_dir=out_path):
     ''' Calculates total patients per practice and of whom how many have had a vaccine to date, or declined
     Note: those declining only include those who have not later received a vaccine.
     '''
-    cohort = pd.read_pickle(input_path)
+    cohort = load_cohort(input_path, ["wave", "practice", "vacc_group", "decline_group", "patient_id"])
 
     # limit to priority groups (ages 50+ and clinical priority groups)
     cohort = cohort.loc[cohort["wave"]!=0]
@@ -94,12 +96,12 @@ def practice_variation(input_path="output/cohort.pickle", output_dir=out_path):
 
 
 
-def declined_vaccinated(input_path="output/cohort.pickle", output_dir=out_path):
+def declined_vaccinated(input_path="output/cohort", output_dir=out_path):
     ''' Counts patients who went from "Declined" to "Vaccinated".
         Creates a chart. 
     '''
 
-    cohort = pd.read_pickle(input_path)
+    cohort = load_cohort(input_path, ["wave", "vacc_group", "declined_accepted_group", "decline_total_group", "patient_id"])
 
     cohort["wave"] = cohort["wave"].astype(str)
     cohort = cohort[["wave", "vacc_group", "declined_accepted_group", "decline_total_group", "patient_id"]]\
@@ -134,13 +136,13 @@ def declined_vaccinated(input_path="output/cohort.pickle", output_dir=out_path):
 
 
 
-def decl_acc_time_delay(input_path="output/cohort.pickle", output_dir=out_path):
+def decl_acc_time_delay(input_path="output/cohort", output_dir=out_path):
     '''
     Measures the time between recorded decline and vaccination for each pt in the declined-then-accepted group,
     and groups to number of weeks.
     '''
 
-    cohort = pd.read_pickle(input_path)
+    cohort = load_cohort(input_path, ["wave", "declined_accepted_group", "patient_id", "vacc1_dat", "decl_first_dat", "high_level_ethnicity"])
 
     # limit to priority groups (ages 50+ and clinical priority groups)
     cohort = cohort.loc[cohort["wave"]!=0]
@@ -170,10 +172,11 @@ def decl_acc_time_delay(input_path="output/cohort.pickle", output_dir=out_path):
     cohort_a = cohort_a.rename(index=wave_column_headings)
     
     # low number suppression and rounding
-    cohort_a = cohort_a.replace([1,2,3,4,5,6], 0)
-    cohort_a = ((cohort_a // 7) * 7).astype(int)
+    cohort_a, modified_a = redact_table(cohort_a, low_number_suppression)
+    cohort_a = cohort_a.astype(int)
 
     cohort_a.to_csv(f"{output_dir}/declined_accepted_weeks_by_wave.csv")
+    record_redactions(f"{output_dir}/declined_accepted_weeks_by_wave.csv", modified_a)
 
     
     # look at priority groups split by demographics
@@ -188,19 +191,8 @@ def decl_acc_time_delay(input_path="output/cohort.pickle", output_dir=out_path):
     cohort_b = cohort_b.rename(index=wave_column_headings)
 
     # low number suppression and rounding
-    cohort_b = cohort_b.replace([1,2,3,4,5,6], 0)
-    cohort_b = ((cohort_b // 7) * 7).astype(int)
+    cohort_b, modified_b = redact_table(cohort_b, low_number_suppression)
+    cohort_b = cohort_b.astype(int)
 
     cohort_b.to_csv(f"{output_dir}/declined_accepted_weeks_by_wave_and_ethnicity.csv")
-    
-
-def invert_df(df, group="all"):
-    ''' "Inverts" df: 
-    calculates the difference between the total population ("total" row) and 
-    each other row in turn, so if `df` counts "patients vaccinated", the resulting
-    df counts "patients NOT vaccinated".
-    '''
-    for i in df.index.drop("total"):
-        df.loc[i] = df.loc["total"] - df.loc[i]
-
-    return df
+    record_redactions(f"{output_dir}/declined_accepted_weeks_by_wave_and_ethnicity.csv", modified_b)
@@ -0,0 +1,81 @@
+"""Data-quality checks, gathered by transform_fast while it has the data in memory.
+
+cohort_checks.py reports the earliest and latest value of each date column in the
+extract, and cohort_pickle_checks.py the share of declines whose first decline date
+is before the start of the vaccination campaign.  Rather than reading the extract or
+the cohort again, they can use the checks that are gathered here, and stored with
+the cohort (see cohort_store.write_checks):
+
+    * the earliest and latest value, and the number of nulls, of each date column
+      that the transform reads, before any records are excluded (cohort_checks.py
+      checks any other date columns in the extract itself)
+    * the number of dates in each column that replace_unknown_dates rewrote
+    * the number of patients with a decline whose first decline date is before, or
+      on or after, the start of the campaign
+
+Each function adds to the checks that it is given, so that they can be gathered over
+several blocks of the extract.
+"""
+
+import numpy as np
+
+from comparisons import lt, notnull
+
+campaign_start = "2020-12-08"
+
+
+def new_checks():
+    return {
+        "dates": {},
+        "rewritten_dates": {},
+        "declines": {"before_campaign": 0, "during_campaign": 0},
+    }
+
+
+def check_dates(cohort, checks):
+    """Add the earliest and latest value, and the number of nulls, of each date
+    column."""
+
+    for col in cohort.columns:
+        values = cohort[col].values
+        if values.dtype.kind != "M":
+            continue
+
+        stats = checks["dates"].setdefault(col, {"min": None, "max": None, "nulls": 0})
+        null = np.isnat(values)
+        stats["nulls"] += int(null.sum())
+        if null.all():
+            continue
+
+        values = values[~null]
+        stats["min"] = earliest(stats["min"], values.min())
+        stats["max"] = latest(stats["max"], values.max())
+
+
+def earliest(a, b):
+    return b if a is None else min(a, b)
+
+
+def latest(a, b):
+    return b if a is None else max(a, b)
+
+
+def count_rewritten_dates(checks, col, rewritten):
+    """Add the number of dates in `col` that were rewritten, given as a boolean
+    mask."""
+
+    counts = checks["rewritten_dates"]
+    counts[col] = counts.get(col, 0) + int(rewritten.sum())
+
+
+def check_declines(cohort, checks):
+    """Count the patients with a decline whose first decline date is before, and on
+    or after, the start of the campaign."""
+
+    decl_first_dat = cohort["decl_first_dat"]
+    declined = notnull(decl_first_dat)
+    before_campaign = int((declined & lt(decl_first_dat, campaign_start)).sum())
+
+    declines = checks["declines"]
+    declines["before_campaign"] += before_campaign
+    declines["during_campaign"] += int(declined.sum()) - before_campaign
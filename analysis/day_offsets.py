@@ -0,0 +1,72 @@
+"""A compact representation of date columns, as whole days since the start of the
+vaccination campaign.
+
+Dates in the cohort are only ever whole days, so rather than storing each as an
+8-byte datetime64, we can store the number of days between the date and `epoch`.
+This fits into an int16 for dates between 1931 and 2110, and into an int32
+otherwise.
+
+Nulls are represented by the smallest value of the integer type.  Since this is
+smaller than any real date, a null date compares as being earlier than every other
+date, which is what the PRIMIS spec requires (see comparisons.py).
+"""
+
+import numpy as np
+
+# Start of the vaccination campaign
+epoch = np.datetime64("2020-12-08", "D")
+
+# The integer types of day offsets
+offset_dtypes = [np.dtype(np.int16), np.dtype(np.int32)]
+
+
+def to_day_offsets(dates):
+    """Convert an array or Series of datetimes into an array of day offsets.
+
+    The offsets are int16 if the dates fit, and int32 otherwise.
+    """
+
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    null = np.isnat(dates)
+    offsets = (dates - epoch).astype(np.int64)
+
+    dtype = np.int32
+    if null.all() or (
+        offsets[~null].min() > np.iinfo(np.int16).min
+        and offsets[~null].max() <= np.iinfo(np.int16).max
+    ):
+        dtype = np.int16
+
+    offsets[null] = null_value(dtype)
+    return offsets.astype(dtype)
+
+
+def from_day_offsets(offsets):
+    """Convert an array of day offsets into an array of datetime64[ns]."""
+
+    offsets = np.asarray(offsets)
+    null = offsets == null_value(offsets.dtype)
+
+    dates = np.full(offsets.shape, np.datetime64("NaT"), dtype="datetime64[ns]")
+    dates[~null] = epoch + offsets[~null].astype("timedelta64[D]")
+    return dates
+
+
+def to_day_offset(date):
+    """Convert a single date (eg "2020-12-08") into a day offset."""
+
+    return int((np.datetime64(date, "D") - epoch).astype(np.int64))
+
+
+def null_value(dtype):
+    return np.iinfo(dtype).min
+
+
+def is_day_offsets(values):
+    """Return whether `values` holds day offsets, as returned by to_day_offsets.
+
+    Day offsets are int16 or int32, which no other column in the cohort is, so that
+    other integer columns (such as ages) are not mistaken for dates.
+    """
+
+    return getattr(values, "dtype", None) in offset_dtypes
@@ -0,0 +1,104 @@
+"""Disclosure control of the counts in output tables.
+
+Small counts could identify patients, so the counts in a table are redacted before
+it is written, according to a policy.  A policy is a dict with any of:
+
+    * "suppress_up_to": counts up to and including this are suppressed
+    * "replacement": what suppressed counts are replaced with (0 by default, or NaN
+      to leave them out of the table)
+    * "multiple": counts are then rounded down to a multiple of this
+
+The policies used by the outputs are defined here, so that the same counts are
+redacted in the same way wherever they are written.
+
+When a table is written, the number of its counts that were changed is recorded in
+redactions.json, in the same directory (see record_redactions).
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Counts are rounded down to a multiple of 7
+rounding = {"multiple": 7}
+
+# Counts of 6 or fewer are set to 0, and the rest are rounded down to a multiple of 7
+low_number_suppression = {"suppress_up_to": 6, "multiple": 7}
+
+# Counts of 3 or fewer practices are left out
+practice_count_suppression = {"suppress_up_to": 3, "replacement": np.nan}
+
+redactions_filename = "redactions.json"
+
+
+def redact(values, policy):
+    """Apply `policy` to an array of counts of any shape, such as an uptake cube or
+    a slice of one, and return the redacted array, and a boolean array which is True
+    where a count was changed."""
+
+    values = np.asarray(values)
+    redacted = values
+    modified = np.zeros(values.shape, dtype=bool)
+
+    if "suppress_up_to" in policy:
+        replacement = policy.get("replacement", 0)
+        suppressed = values <= policy["suppress_up_to"]
+        # As with pandas' replace, the array keeps its dtype if nothing is suppressed
+        if suppressed.any():
+            redacted = np.where(suppressed, replacement, values)
+            modified |= suppressed & (values != replacement)
+
+    if "multiple" in policy:
+        multiple = policy["multiple"]
+        rounded = (redacted // multiple) * multiple
+        # NaN is never equal to itself, but is left as it is
+        unchanged = (rounded == redacted) | (pd.isnull(rounded) & pd.isnull(redacted))
+        modified |= ~unchanged
+        redacted = rounded
+
+    return redacted, modified
+
+
+def redact_table(table, policy):
+    """As redact, for a Series or DataFrame, returning objects of the same kind with
+    the same index (and columns)."""
+
+    redacted, modified = redact(table.values, policy)
+    if isinstance(table, pd.Series):
+        return (
+            pd.Series(redacted, index=table.index, name=table.name),
+            pd.Series(modified, index=table.index, name=table.name),
+        )
+
+    # The counts are redacted as a single array, but, as with pandas' replace, each
+    # column keeps its dtype unless a count in it was replaced with NaN
+    frame = pd.DataFrame(redacted, index=table.index, columns=table.columns)
+    replaced_with_nan = (frame.isnull() & table.notnull()).any()
+    frame = frame.astype(table.dtypes[~replaced_with_nan].to_dict())
+    return frame, pd.DataFrame(modified, index=table.index, columns=table.columns)
+
+
+def record_redactions(table_path, modified):
+    """Record, in redactions.json in the directory of `table_path`, the number of
+    counts in the table written there, and the number that were changed, given
+    `modified` as returned by redact or redact_table.
+
+    The file maps the filename of each table to its counts, and is updated in
+    place, so that it covers every table written to the directory.
+    """
+
+    path = os.path.join(os.path.dirname(table_path), redactions_filename)
+    redactions = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            redactions = json.load(f)
+
+    modified = np.asarray(modified)
+    redactions[os.path.basename(table_path)] = {
+        "cells": int(modified.size),
+        "modified": int(modified.sum()),
+    }
+    with open(path, "w") as f:
+        json.dump(redactions, f, indent=2, sort_keys=True)
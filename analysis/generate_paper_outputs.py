@@ -1,6 +1,7 @@
 import base64
 import os
 from datetime import datetime, timedelta
+from multiprocessing import Pool
 
 import jinja2
 import matplotlib as mpl
@@ -18,6 +19,10 @@ from age_bands import age_bands
 # Ensure SVGs are created reproducibly
 mpl.rcParams["svg.hashsalt"] = 42
 
+# The charts to be rendered at the end of run, as (function, args) pairs, when they
+# are rendered in parallel, or None when each chart is rendered as it is plotted
+chart_jobs = None
+
 wave_column_headings = {"":
         {"total": "All",
         "all_priority": "Priority groups",
@@ -68,7 +73,30 @@ class IntArrayFormatter(pd.io.formats.format.GenericArrayFormatter):
 pd.io.formats.format.IntArrayFormatter = IntArrayFormatter
 
 
-def run(base_path, earliest_date, latest_date):
+def run(base_path, earliest_date, latest_date, workers=1):
+    """Write the summary tables and charts, rendering the charts in `workers`
+    processes (or one per core if `workers` is less than 1).
+
+    With more than one worker, the charts are collected as they are plotted, and
+    rendered once all the tables have been written.
+    """
+
+    global chart_jobs
+
+    if workers < 1:
+        workers = os.cpu_count()
+    if workers > 1:
+        chart_jobs = []
+        try:
+            write_outputs(base_path, earliest_date, latest_date)
+            render_charts(chart_jobs, workers)
+        finally:
+            chart_jobs = None
+    else:
+        write_outputs(base_path, earliest_date, latest_date)
+
+
+def write_outputs(base_path, earliest_date, latest_date):
     backend = base_path.rstrip("/").split("/")[-1]
     demographic_titles = get_demographic_titles()
     label_maps = get_label_maps()
@@ -556,6 +584,20 @@ def get_label_maps():
     return labels
 
 
+def render_charts(jobs, workers):
+    """Render the charts in `jobs` in a pool of `workers` processes."""
+
+    with Pool(workers, initializer=plt.switch_backend, initargs=("Agg",)) as pool:
+        # Hand out one chart at a time, so that no worker is left with a backlog
+        for _ in pool.imap_unordered(render_chart_job, jobs):
+            pass
+
+
+def render_chart_job(job):
+    render, args = job
+    render(*args)
+
+
 def plot_chart(
     df,
     title,
@@ -563,6 +605,13 @@ def plot_chart(
     cohort_average=None,
     is_percent=True
 ):
+    if chart_jobs is not None:
+        chart_jobs.append((render_chart, (df, title, out_path, cohort_average, is_percent)))
+    else:
+        render_chart(df, title, out_path, cohort_average, is_percent)
+
+
+def render_chart(df, title, out_path, cohort_average, is_percent):
     df = df.loc['2020-12-08':]
     df.index = pd.to_datetime(df.index)
     ax = plt.gca()
@@ -610,6 +659,13 @@ def plot_chart(
 
 
 def plot_stacked_chart(df, title, out_path):
+    if chart_jobs is not None:
+        chart_jobs.append((render_stacked_chart, (df, title, out_path)))
+    else:
+        render_stacked_chart(df, title, out_path)
+
+
+def render_stacked_chart(df, title, out_path):
     ax = plt.gca()
     df.plot(kind='bar', stacked=True, ax=ax)
 
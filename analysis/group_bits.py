@@ -0,0 +1,59 @@
+"""Boolean group columns packed into bits, with one bit per patient.
+
+A packed column takes an eighth of the space of a bool column.  The number of
+patients in a group, or in the intersection of two groups, can be counted directly
+from the packed bytes, by looking up the number of set bits in each byte, without
+unpacking them.
+
+The bits for several groups are held in a matrix, with one row per group.  The
+cohort can be stored with its group columns packed in this way (see
+cohort_store.py).
+"""
+
+import numpy as np
+
+# The number of set bits in each possible byte
+popcounts = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+
+def pack(mask):
+    """Pack a boolean array or Series into bits."""
+
+    return np.packbits(np.asarray(mask, dtype=bool))
+
+
+def pack_groups(cohort, groups):
+    """Return a matrix of bits, with one row per group, in the order given."""
+
+    return np.array([pack(cohort[group].values) for group in groups], dtype=np.uint8)
+
+
+def unpack(bits, nrows):
+    """Unpack bits into a boolean array of length `nrows`, for filtering."""
+
+    return np.unpackbits(bits, count=nrows).astype(bool)
+
+
+def popcount(bits):
+    """Return the number of set bits."""
+
+    return int(popcounts[bits].sum(dtype=np.int64))
+
+
+def pack_by_value(values):
+    """Return a dict mapping each distinct value of an array or Series to the bits
+    of the rows with that value.
+
+    The number of members of a group with a given value can then be counted with
+    popcount(group_bits & value_bits).
+    """
+
+    values = np.asarray(values)
+    return {value: pack(values == value) for value in np.unique(values)}
+
+
+def count_by_value(bits, value_bits):
+    """Return a dict mapping each value to the number of set bits among the rows
+    with that value, where `value_bits` is as returned by pack_by_value."""
+
+    return {value: popcount(bits & rows) for value, rows in value_bits.items()}
@@ -0,0 +1,273 @@
+"""A small language for the rules in the PRIMIS spec that assign patients to groups.
+
+A rule is built from the functions below, for instance:
+
+    all_of(is_set("ckd15_dat"), gte("ckd35_dat", "ckd15_dat"))
+
+and can be compiled in two ways:
+
+    * compile_vectorised(rule) returns a function that takes a dataframe and returns
+      a boolean array, with one element per row.  The parts of a rule are combined
+      in place, so evaluating a rule allocates only a few arrays, rather than one
+      Series per step.
+    * compile_row(rule, index) returns a function that takes a row (a list of
+      values, with positions given by `index`) and returns True or False.
+
+In a dataframe, a date is set if it is not null, and in a row, if it is not "".
+Groups are booleans, and are set if they are True.
+
+Comparisons between dates follow the PRIMIS spec (see comparisons.py), so that a
+date that is set is later than one that is not.  The right hand side of a comparison
+may be a column or a constant date, given with date().
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def is_set(col):
+    return ("is_set", col)
+
+
+def is_null(col):
+    return ("is_null", col)
+
+
+def gt(lhs, rhs):
+    """lhs is set, and either rhs is null or lhs > rhs."""
+    return ("gt", lhs, rhs)
+
+
+def gte(lhs, rhs):
+    """lhs is set, and either rhs is null or lhs >= rhs."""
+    return ("gte", lhs, rhs)
+
+
+def lte(lhs, rhs):
+    """rhs is set, and either lhs is null or lhs <= rhs."""
+    return ("lte", lhs, rhs)
+
+
+def at_least(col, threshold):
+    """col is set and is at least threshold."""
+    return ("at_least", col, threshold)
+
+
+def below(col, threshold):
+    """col is set and is below threshold."""
+    return ("below", col, threshold)
+
+
+def equals(col, value):
+    return ("equals", col, value)
+
+
+def any_of(*rules):
+    return ("any_of", rules)
+
+
+def all_of(*rules):
+    return ("all_of", rules)
+
+
+def date(value):
+    """A constant date, eg date("2020-12-08"), for the right hand side of a
+    comparison."""
+    return ("date", value)
+
+
+def get_columns(rule):
+    """Return the names of the columns that a rule reads."""
+
+    op, *args = rule
+    if op in ["any_of", "all_of"]:
+        return [col for subrule in args[0] for col in get_columns(subrule)]
+    if op in ["gt", "gte", "lte"]:
+        return [operand for operand in args if not is_constant(operand)]
+    return [args[0]]
+
+
+def is_constant(operand):
+    return isinstance(operand, tuple) and operand[0] == "date"
+
+
+def compile_vectorised(rule):
+    """Return a function that evaluates the rule for every row of a dataframe."""
+
+    op, *args = rule
+
+    if op in ["any_of", "all_of"]:
+        fns = [compile_vectorised(subrule) for subrule in args[0]]
+
+        def evaluate(df):
+            result = np.array(fns[0](df), dtype=bool)
+            for fn in fns[1:]:
+                if op == "any_of":
+                    result |= fn(df)
+                else:
+                    result &= fn(df)
+            return result
+
+        return evaluate
+
+    if op == "is_set":
+        (col,) = args
+        return lambda df: values_are_set(df[col].values)
+
+    if op == "is_null":
+        (col,) = args
+        return lambda df: ~values_are_set(df[col].values)
+
+    if op in ["gt", "gte", "lte"]:
+        lhs, rhs = args
+        return compile_vectorised_comparison(op, lhs, rhs)
+
+    if op == "at_least":
+        col, threshold = args
+        # Comparisons with NaN are False
+        return lambda df: df[col].values >= threshold
+
+    if op == "below":
+        col, threshold = args
+        return lambda df: df[col].values < threshold
+
+    if op == "equals":
+        col, value = args
+        return lambda df: df[col].values == value
+
+    raise ValueError(f"Unknown rule: {op}")
+
+
+def compile_vectorised_comparison(op, lhs, rhs):
+    def get_operand(df, operand):
+        if is_constant(operand):
+            # np.False_ rather than False, since ~False is -1
+            return np.datetime64(operand[1]), np.False_
+        values = df[operand].values
+        return values, pd.isnull(values)
+
+    def evaluate(df):
+        lhs_values, lhs_null = get_operand(df, lhs)
+        rhs_values, rhs_null = get_operand(df, rhs)
+
+        # Comparisons with NaT are False, so when both sides are set these give the
+        # result of the comparison, and when either is null they give False.
+        if op == "gt":
+            result = lhs_values > rhs_values
+            result |= ~lhs_null & rhs_null
+        elif op == "gte":
+            result = lhs_values >= rhs_values
+            result |= ~lhs_null & rhs_null
+        else:
+            result = lhs_values <= rhs_values
+            result |= lhs_null & ~rhs_null
+        return result
+
+    return evaluate
+
+
+def values_are_set(values):
+    if values.dtype == bool:
+        return values
+    return ~pd.isnull(values)
+
+
+def compile_row(rule, index):
+    """Return a function that evaluates the rule for a single row."""
+
+    op, *args = rule
+
+    if op == "any_of":
+        fns = [compile_row(subrule, index) for subrule in args[0]]
+
+        def evaluate(row):
+            for fn in fns:
+                if fn(row):
+                    return True
+            return False
+
+        return evaluate
+
+    if op == "all_of":
+        fns = [compile_row(subrule, index) for subrule in args[0]]
+
+        def evaluate(row):
+            for fn in fns:
+                if not fn(row):
+                    return False
+            return True
+
+        return evaluate
+
+    if op == "is_set":
+        ix = index[args[0]]
+        return lambda row: bool(row[ix])
+
+    if op == "is_null":
+        ix = index[args[0]]
+        return lambda row: not row[ix]
+
+    if op in ["gt", "gte", "lte"]:
+        lhs, rhs = args
+        return compile_row_comparison(op, lhs, rhs, index)
+
+    if op == "at_least":
+        col, threshold = args
+        ix = index[col]
+        return lambda row: row[ix] != "" and float(row[ix]) >= threshold
+
+    if op == "below":
+        col, threshold = args
+        ix = index[col]
+        return lambda row: row[ix] != "" and float(row[ix]) < threshold
+
+    if op == "equals":
+        col, value = args
+        ix = index[col]
+        return lambda row: row[ix] == value
+
+    raise ValueError(f"Unknown rule: {op}")
+
+
+def compile_row_comparison(op, lhs, rhs, index):
+    # Dates in a row are ISO 8601 strings, which sort in the same order as the dates
+    lhs_ix = index[lhs]
+
+    if is_constant(rhs):
+        value = rhs[1]
+        if op == "gt":
+            return lambda row: bool(row[lhs_ix]) and row[lhs_ix] > value
+        if op == "gte":
+            return lambda row: bool(row[lhs_ix]) and row[lhs_ix] >= value
+        return lambda row: not row[lhs_ix] or row[lhs_ix] <= value
+
+    rhs_ix = index[rhs]
+
+    if op == "gt":
+
+        def evaluate(row):
+            lhs_value = row[lhs_ix]
+            if not lhs_value:
+                return False
+            rhs_value = row[rhs_ix]
+            return not rhs_value or lhs_value > rhs_value
+
+    elif op == "gte":
+
+        def evaluate(row):
+            lhs_value = row[lhs_ix]
+            if not lhs_value:
+                return False
+            rhs_value = row[rhs_ix]
+            return not rhs_value or lhs_value >= rhs_value
+
+    else:
+
+        def evaluate(row):
+            rhs_value = row[rhs_ix]
+            if not rhs_value:
+                return False
+            lhs_value = row[lhs_ix]
+            return not lhs_value or lhs_value <= rhs_value
+
+    return evaluate
@@ -8,6 +8,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.ticker import PercentFormatter
 
+from disclosure import practice_count_suppression, record_redactions, redact_table
+
 def plot_hist(df=None, dfs= None, output_dir=None): 
     '''
     Plots 2 practice histograms, for (a) number of declined vaccines per 1000 population, and 
@@ -34,8 +36,9 @@ def plot_hist(df=None, dfs= None, output_dir=None):
             binned = pd.cut(out[x], bins=bins[n], labels=labels[n], retbins=False, include_lowest=True, right=False)
             
             # save with absolute counts (not %) to csv with suppression of low practice counts
-            binnedcsv = pd.DataFrame(binned.value_counts()).sort_index().replace([0,1,2,3],np.NaN)
+            binnedcsv, modified = redact_table(pd.DataFrame(binned.value_counts()).sort_index(), practice_count_suppression)
             binnedcsv.to_csv(f'{output_dir}/practice_list_size_{x}.csv')
+            record_redactions(f'{output_dir}/practice_list_size_{x}.csv', modified)
             
             binned = pd.DataFrame(binned.value_counts(normalize=True)).sort_index()
             dfs[x] = binned
@@ -144,7 +147,9 @@ def plot_heatmap(df=None, dfs=None, backend=None, output_dir=None):
             plotting.columns = plotting.columns.droplevel()
 
             # export csv
-            plotting.replace([0,1,2,3],np.NaN).to_csv(f'{output_dir}/practice_list_size_2_{x}.csv')
+            redacted, modified = redact_table(plotting, practice_count_suppression)
+            redacted.to_csv(f'{output_dir}/practice_list_size_2_{x}.csv')
+            record_redactions(f'{output_dir}/practice_list_size_2_{x}.csv', modified)
             dfs[x] = plotting
 
     fig, axs = plt.subplots(len(dfs), 1, tight_layout=True, figsize=(6,len(dfs)*4))
@@ -0,0 +1,25 @@
+"""Helpers for working with rows that are lists of values, rather than dicts.
+
+Looking up a value by position is much cheaper than looking it up by name, so we
+resolve the position of each column once, from the header, and then use the
+positions for every row.
+"""
+
+from operator import itemgetter
+
+
+def get_index(fieldnames):
+    """Return a mapping from each column name to its position in a row."""
+
+    return {fn: ix for ix, fn in enumerate(fieldnames)}
+
+
+def make_getter(index, fieldnames):
+    """Return a function that returns a tuple of the values of the given columns."""
+
+    positions = [index[fn] for fn in fieldnames]
+    if len(positions) == 1:
+        # itemgetter with one item returns the value rather than a 1-tuple
+        (position,) = positions
+        return lambda row: (row[position],)
+    return itemgetter(*positions)
@@ -1,4 +1,5 @@
 from generate_paper_outputs import run
+import argparse
 import os
 
 backend = os.getenv("OPENSAFELY_BACKEND", "expectations")
@@ -6,7 +7,16 @@ base_path = f"output/{backend}"
 start_date = "2020-12-01"
 end_date = "2021-05-25"
 
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of processes in which to render the charts (0 for one per core)",
+)
+args = parser.parse_args()
+
 # create cumulative charts
-run(base_path, start_date, end_date)
+run(base_path, start_date, end_date, workers=args.workers)
 
 
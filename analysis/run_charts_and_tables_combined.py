@@ -4,13 +4,23 @@ and stacked bar charts of vaccines/declines broken down by certain factors.
 Additionally compiles selected tables together into single summary tables, e.g. to show each wave broken down by ethncity. '''
 
 from generate_paper_outputs import run
+import argparse
 import pandas as pd
 import glob
 from groups import groups, at_risk_groups
 from config_for_combined_outputs import base_path, start_date, end_date
 
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of processes in which to render the charts (0 for one per core)",
+)
+args = parser.parse_args()
+
 # create cumulative charts
-run(base_path, start_date, end_date)
+run(base_path, start_date, end_date, workers=args.workers)
 
 
 def other_table_combinations():
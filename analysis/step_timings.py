@@ -0,0 +1,179 @@
+"""Opt-in timing of the steps of the transforms.
+
+When enabled, each step of transform_fast.transform, and each row-wise step in
+transform_slow.transform_rows, records:
+
+    * the wall time and CPU time that it took
+    * how much the peak resident set size (RSS) of the process grew while it ran
+    * the number of rows before and after it ran
+
+Steps that are run more than once (once per block of the input, or once per row)
+have their figures summed.  The peak RSS is not measured around each call of a
+row-wise step, since a single row makes no difference to it, and would be expensive
+to measure; transform_slow records the RSS of the whole row-wise transform instead.
+
+Timings are recorded in the process that runs the step, so workers must return
+theirs with their results (see transform_slow.transform_sharded).
+"""
+
+import csv
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+fieldnames = [
+    "engine",
+    "step",
+    "calls",
+    "rows_in",
+    "rows_out",
+    "wall_time",
+    "cpu_time",
+    "peak_rss_delta_kb",
+]
+summed_fieldnames = fieldnames[2:]
+
+# The report is written in the directory of the cohort, with its other files
+report_filename = "steps.csv"
+
+# Maps (engine, step) to a dict of figures, in the order in which the steps first
+# ran, or is None if timing is not enabled
+timings = None
+
+
+def enable():
+    global timings
+    timings = {}
+
+
+def is_enabled():
+    return timings is not None
+
+
+def collect():
+    """Return the timings recorded in this process so far, and reset them."""
+
+    global timings
+    if timings is None:
+        return {}
+    collected, timings = timings, {}
+    return collected
+
+
+def add(collected):
+    """Add timings returned by collect() in another process to those recorded here."""
+
+    for (engine, step), figures in collected.items():
+        entry = get_entry(engine, step)
+        for fn in summed_fieldnames:
+            entry[fn] = add_figures(entry[fn], figures[fn])
+
+
+def add_figures(a, b):
+    # A figure is None if it was not measured
+    if a is None or b is None:
+        return None
+    return a + b
+
+
+def get_entry(engine, step):
+    key = (engine, step)
+    if key not in timings:
+        timings[key] = dict.fromkeys(summed_fieldnames, 0)
+    return timings[key]
+
+
+def get_peak_rss():
+    # On Linux, ru_maxrss is in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+@contextmanager
+def timed(engine, step, df=None):
+    """Time the code in the block as a step, counting the rows of `df` (if given)
+    before and after."""
+
+    if timings is None:
+        yield
+        return
+
+    entry = get_entry(engine, step)
+    rows_in = None if df is None else len(df)
+    wall, cpu, rss = time.perf_counter(), time.process_time(), get_peak_rss()
+    yield
+    entry["wall_time"] += time.perf_counter() - wall
+    entry["cpu_time"] += time.process_time() - cpu
+    entry["peak_rss_delta_kb"] += get_peak_rss() - rss
+    entry["calls"] += 1
+    entry["rows_in"] = add_figures(entry["rows_in"], rows_in)
+    entry["rows_out"] = add_figures(entry["rows_out"], None if df is None else len(df))
+
+
+def run_step(engine, fn, df, *args):
+    """Call fn(df, *args), as a step that modifies `df` in place."""
+
+    with timed(engine, fn.__name__, df):
+        return fn(df, *args)
+
+
+def time_row_step(engine, step):
+    """Wrap a row-wise step, which modifies the row it is called with, so that each
+    call is timed."""
+
+    entry = get_entry(engine, step.__name__)
+    entry["peak_rss_delta_kb"] = None
+    perf_counter, process_time = time.perf_counter, time.process_time
+
+    def timed_step(row):
+        wall, cpu = perf_counter(), process_time()
+        step(row)
+        entry["wall_time"] += perf_counter() - wall
+        entry["cpu_time"] += process_time() - cpu
+        entry["calls"] += 1
+        entry["rows_in"] += 1
+        entry["rows_out"] += 1
+
+    return timed_step
+
+
+def time_row_exclusion(engine, exclusion):
+    """Wrap a row-wise exclusion, which returns True if a row is to be dropped, so
+    that each call is timed."""
+
+    entry = get_entry(engine, exclusion.__name__)
+    entry["peak_rss_delta_kb"] = None
+    perf_counter, process_time = time.perf_counter, time.process_time
+
+    def timed_exclusion(value):
+        wall, cpu = perf_counter(), process_time()
+        excluded = exclusion(value)
+        entry["wall_time"] += perf_counter() - wall
+        entry["cpu_time"] += process_time() - cpu
+        entry["calls"] += 1
+        entry["rows_in"] += 1
+        entry["rows_out"] += not excluded
+        return excluded
+
+    return timed_exclusion
+
+
+def write_report(path, engine):
+    """Write the timings of the steps run by `engine` to a CSV file in the cohort
+    directory at `path`."""
+
+    with open(os.path.join(path, report_filename), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames)
+        writer.writeheader()
+        for (step_engine, step), figures in (timings or {}).items():
+            if step_engine == engine:
+                writer.writerow(dict(figures, engine=engine, step=step))
+
+
+def remove_report(path):
+    """Remove any report written in the cohort directory at `path` by an earlier
+    run, which would not describe the cohort written since."""
+
+    report_path = os.path.join(path, report_filename)
+    if os.path.exists(report_path):
+        os.remove(report_path)
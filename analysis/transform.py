@@ -1,21 +1,152 @@
+import argparse
 import os
+import sys
 
-import transform_fast, transform_slow
+import step_timings, transform_cache, transform_fast, transform_incremental, transform_slow
 
+# The engines that each backend runs, in the order of their output paths
+engines = {"emis": ["slow"], "tpp": ["fast"], "expectations": ["slow", "fast"]}
+
+
+def run(
+    input_path="output/input.csv",
+    output_path="output/cohort",
+    chunksize=None,
+    workers=1,
+    compact_dates=False,
+    packed_groups=False,
+    cache_dir=None,
+    cache_size=transform_cache.default_max_size,
+    previous_input_path=None,
+    time_steps=False,
+):
+    """Transform the input, or if `cache_dir` is given and the cohort for this input
+    and code has been cached there, restore it from the cache.  The cache is not
+    used when the steps are timed, since restoring a cohort runs none of them.
+
+    If `previous_input_path` is given, the stored cohort is updated by transforming
+    only the patients whose rows differ from those in that extract (see
+    transform_incremental.py).
+
+    If `time_steps` is True, the time taken by each step of the transform is written
+    to a CSV file in each cohort directory (see step_timings.py).
+    """
 
-def run(input_path="output/input.csv", output_path="output/cohort.pickle"):
     backend = os.getenv("OPENSAFELY_BACKEND", "expectations")
+    storage = {"compact_dates": compact_dates, "packed_groups": packed_groups}
+
+    if backend == "expectations":
+        output_paths = ["output/cohort_slow", output_path]
+    else:
+        output_paths = [output_path]
+
+    if time_steps:
+        cache_dir = None
 
-    if backend == "emis":
-        transform_slow.run(input_path, output_path)
+    if cache_dir:
+        # This module (which may be run as __main__) and transform_incremental
+        # dispatch to the transforms, and merge their results
+        modules = [
+            sys.modules[__name__],
+            transform_fast,
+            transform_slow,
+            transform_incremental,
+        ]
+        key = transform_cache.get_key(input_path, dict(storage, backend=backend), modules)
+        if transform_cache.restore(cache_dir, key, output_paths):
+            return
+
+    if time_steps:
+        step_timings.enable()
+
+    if previous_input_path:
+        for engine, path in zip(engines[backend], output_paths):
+            transform_incremental.run(
+                engine,
+                input_path,
+                previous_input_path,
+                path,
+                chunksize=chunksize,
+                workers=workers,
+                **storage,
+            )
+
+    elif backend == "emis":
+        transform_slow.run(input_path, output_path, workers=workers, **storage)
     elif backend == "tpp":
-        transform_fast.run(input_path, output_path)
+        transform_fast.run(input_path, output_path, chunksize=chunksize, **storage)
         
     elif backend == "expectations":
-        transform_slow.run(input_path, "output/cohort_slow.pickle")
-        transform_fast.run(input_path, output_path)
+        transform_slow.run(input_path, "output/cohort_slow", workers=workers, **storage)
+        transform_fast.run(input_path, output_path, chunksize=chunksize, **storage)
+
+    for engine, path in zip(engines[backend], output_paths):
+        if time_steps:
+            step_timings.write_report(path, engine)
+        else:
+            step_timings.remove_report(path)
+
+    if cache_dir:
+        transform_cache.store(cache_dir, key, output_paths, max_size=cache_size)
+
 
 if __name__ == "__main__":
-    import sys
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_path")
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        help="Read and transform the input in blocks of this many rows",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes for the row-wise transform (0 for one per core)",
+    )
+    parser.add_argument(
+        "--compact-dates",
+        action="store_true",
+        help="Store date columns as days since the start of the campaign",
+    )
+    parser.add_argument(
+        "--packed-groups",
+        action="store_true",
+        help="Store boolean group columns packed into bits",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.getenv("TRANSFORM_CACHE_DIR"),
+        help="Directory in which to cache transformed cohorts (default: $TRANSFORM_CACHE_DIR)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=transform_cache.default_max_size,
+        help="Maximum size of the cache in bytes",
+    )
+    parser.add_argument(
+        "--previous-input",
+        dest="previous_input_path",
+        help="The previous extract, from which the stored cohort was built; only "
+        "patients whose rows have changed since then are transformed",
+    )
+    parser.add_argument(
+        "--time-steps",
+        action="store_true",
+        help="Write the time taken by each step of the transform to steps.csv in the "
+        "cohort directory (the cache is not used)",
+    )
+    args = parser.parse_args()
 
-    run(input_path=sys.argv[1])
+    run(
+        input_path=args.input_path,
+        chunksize=args.chunksize,
+        workers=args.workers,
+        compact_dates=args.compact_dates,
+        packed_groups=args.packed_groups,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size,
+        previous_input_path=args.previous_input_path,
+        time_steps=args.time_steps,
+    )
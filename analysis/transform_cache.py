@@ -0,0 +1,152 @@
+"""A cache of transformed cohorts, keyed on everything that the cohort depends on.
+
+The key is a hash of the input file, the source of the modules that do the
+transform, the codelist used for ethnicity, and the options that change what is
+written.  If none of these has changed since a cohort was cached, the cached copy
+is restored instead of running the transform again.
+
+Each entry is a directory, named after its key, holding a copy of each cohort that
+the transform wrote.  Entries are copied rather than linked, since writing a cohort
+overwrites its files in place.  When the cache grows beyond a given size, the least
+recently used entries are removed.
+"""
+
+import ast
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+analysis_dir = os.path.dirname(os.path.abspath(__file__))
+codelist_paths = ["codelists/primis-covid19-vacc-uptake-eth2001.csv"]
+
+# 10GB
+default_max_size = 10 * 1024 ** 3
+
+
+def get_key(input_path, options, modules):
+    """Return the cache key for transforming `input_path` with the given options, by
+    the given modules (and the modules in the analysis directory that they use).
+    """
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps(options, sort_keys=True).encode("utf8"))
+
+    for path in [input_path] + get_module_paths(modules) + codelist_paths:
+        digest.update(os.path.basename(path).encode("utf8"))
+        update_from_file(digest, path)
+
+    return digest.hexdigest()
+
+
+def get_module_paths(modules):
+    """Return the paths of the given modules, and of every module in the analysis
+    directory that they import, directly or indirectly.
+
+    Imports are read from the source of each module, rather than from the names it
+    defines, so that a module that is imported only for its data (such as age_bands
+    or groups) is followed as well as one whose functions are imported.
+    """
+
+    seen = set()
+    to_visit = [os.path.abspath(module.__file__) for module in modules]
+    while to_visit:
+        path = to_visit.pop()
+        if path in seen or os.path.dirname(path) != analysis_dir:
+            continue
+        seen.add(path)
+
+        for name in get_imported_names(path):
+            imported_path = os.path.join(analysis_dir, name.split(".")[0] + ".py")
+            if os.path.exists(imported_path):
+                to_visit.append(imported_path)
+
+    return sorted(seen)
+
+
+def get_imported_names(path):
+    """Return the names of the modules imported by the module at `path`, including
+    those imported inside functions."""
+
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+
+    names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.append(node.module)
+    return names
+
+
+def update_from_file(digest, path, block_size=1024 * 1024):
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+
+
+def restore(cache_dir, key, output_paths):
+    """Copy the cohorts cached under `key` to `output_paths`, and return True, or
+    return False if there is no such entry."""
+
+    entry_path = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry_path):
+        return False
+
+    for ix, output_path in enumerate(output_paths):
+        shutil.rmtree(output_path, ignore_errors=True)
+        shutil.copytree(os.path.join(entry_path, str(ix)), output_path)
+
+    # Mark the entry as recently used
+    os.utime(entry_path)
+    return True
+
+
+def store(cache_dir, key, output_paths, max_size=default_max_size):
+    """Cache copies of the cohorts at `output_paths` under `key`, and then remove
+    the least recently used entries until the cache is no bigger than `max_size`
+    bytes."""
+
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_path = os.path.join(cache_dir, key)
+
+    # Copy into a temporary directory and then rename it, so that a partly written
+    # entry is never restored
+    tmp_path = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp-")
+    try:
+        for ix, output_path in enumerate(output_paths):
+            shutil.copytree(output_path, os.path.join(tmp_path, str(ix)))
+        shutil.rmtree(entry_path, ignore_errors=True)
+        os.rename(tmp_path, entry_path)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    evict(cache_dir, max_size)
+
+
+def evict(cache_dir, max_size):
+    """Remove the least recently used entries until the cache is no bigger than
+    `max_size` bytes."""
+
+    entries = [
+        os.path.join(cache_dir, name)
+        for name in os.listdir(cache_dir)
+        if not name.startswith(".")
+    ]
+    entries.sort(key=os.path.getmtime, reverse=True)
+
+    total_size = 0
+    for entry_path in entries:
+        total_size += get_size(entry_path)
+        if total_size > max_size:
+            shutil.rmtree(entry_path, ignore_errors=True)
+
+
+def get_size(path):
+    return sum(
+        os.path.getsize(os.path.join(dirpath, filename))
+        for dirpath, _, filenames in os.walk(path)
+        for filename in filenames
+    )
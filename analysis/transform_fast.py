@@ -1,11 +1,21 @@
+import ast
 import csv
+import inspect
+import os
+import textwrap
 
 import numpy as np
 import pandas as pd
 
-from age_bands import add_age_bands
-from add_groupings import add_groupings
+from add_groupings import add_groupings, group_rules
+from bandings import add_age_bands, high_level_ethnicities, imd_bands
+from cohort_store import write_attrition, write_checks, write_cohort
+from comparisons import lt, notnull
+from data_checks import check_dates, check_declines, count_rewritten_dates, new_checks
+from group_rules import get_columns
 from groups import at_risk_groups, groups
+from step_timings import run_step
+from waves import add_waves, add_waves_2, wave_rule_cols
 from datetime import datetime
 
 
@@ -36,87 +46,276 @@ necessary_cols = (
 )
 
 
-def run(input_path="output/input.csv", output_path="output/cohort.pickle"):
-    raw_cohort = load_raw_cohort(input_path)
-    cohort = transform(raw_cohort)
-    cohort[necessary_cols].to_pickle(output_path)
+def run(
+    input_path="output/input.csv",
+    output_path="output/cohort",
+    chunksize=None,
+    compact_dates=False,
+    packed_groups=False,
+):
+    attrition = {}
+    checks = new_checks()
+    cohort = transform_file(input_path, chunksize, attrition, checks)
+    write_cohort(
+        cohort, output_path, compact_dates=compact_dates, packed_groups=packed_groups
+    )
+    write_attrition(output_path, attrition)
+    write_checks(output_path, checks)
+
+
+def transform_file(input_path, chunksize=None, attrition=None, checks=None):
+    """Return the cohort transformed from the input, optionally reading it in blocks
+    of `chunksize` rows.
+
+    If given, the records excluded are counted in `attrition`, and the data-quality
+    checks are gathered in `checks` (see data_checks.py).
+    """
+
+    if chunksize:
+        cohort = pd.concat(
+            transform(raw_cohort, attrition, checks)[necessary_cols]
+            for raw_cohort in load_raw_cohort_chunks(input_path, chunksize)
+        )
+    else:
+        raw_cohort = load_raw_cohort(input_path)
+        cohort = transform(raw_cohort, attrition, checks)
+    return cohort[necessary_cols]
 
 
 def load_raw_cohort(input_path):
+    usecols, date_fieldnames = get_usecols(input_path)
+    raw_cohort = pd.read_csv(input_path, usecols=usecols, dtype=str_dtypes(date_fieldnames))
+    return parse_date_columns(raw_cohort, date_fieldnames, {})
+
+
+def load_raw_cohort_chunks(input_path, chunksize):
+    """Yield the raw cohort in blocks of `chunksize` rows.
+
+    Every step of `transform` only looks at one patient at a time, so each block can
+    be transformed independently, and peak memory depends on `chunksize` rather than
+    on the size of the cohort.  The index carries on from one block to the next, so
+    the concatenated result is the same as when the file is read in one go.
+    """
+
+    usecols, date_fieldnames = get_usecols(input_path)
+    reader = pd.read_csv(
+        input_path, usecols=usecols, dtype=str_dtypes(date_fieldnames), chunksize=chunksize
+    )
+    cache = {}
+    for raw_cohort in reader:
+        yield parse_date_columns(raw_cohort, date_fieldnames, cache)
+
+
+def str_dtypes(fieldnames):
+    return {fn: str for fn in fieldnames}
+
+
+def parse_date_columns(raw_cohort, date_fieldnames, cache):
+    """Return a copy of the raw cohort with columns of date strings converted into
+    datetimes.
+
+    There are only a few hundred distinct dates in each column, so we parse each
+    distinct string once and then broadcast the result back through the column's
+    integer codes.  `cache` maps strings that have already been parsed to dates, and
+    can be shared between columns and between blocks of the same file.
+    """
+
+    parsed = {}
+    for fn in date_fieldnames:
+        codes, uniques = pd.factorize(raw_cohort[fn])
+        unparsed = [value for value in uniques if value not in cache]
+        if unparsed:
+            cache.update(zip(unparsed, pd.to_datetime(unparsed).values))
+        # Missing values have code -1, which picks out the trailing NaT
+        dates = np.array(
+            [cache[value] for value in uniques] + [np.datetime64("NaT")],
+            dtype="datetime64[ns]",
+        )
+        parsed[fn] = dates[codes]
+
+    # Replacing the columns all at once is much quicker than one at a time
+    return pd.concat(
+        [
+            raw_cohort.drop(columns=date_fieldnames),
+            pd.DataFrame(parsed, index=raw_cohort.index),
+        ],
+        axis=1,
+    )[raw_cohort.columns]
+
+
+def get_usecols(input_path):
+    """Return the columns of the raw extract that `transform` reads, and which of
+    these are dates.
+    """
+
     with open(input_path) as f:
         reader = csv.reader(f)
         fieldnames = next(reader)
 
-    date_fieldnames = [fn for fn in fieldnames if fn.endswith("_dat")]
-    raw_cohort = pd.read_csv(input_path, parse_dates=date_fieldnames)
-    return raw_cohort
-
-
-def transform(cohort):
-    """Transform data generated by study definition."""
-
-    drop_non_fm_sex(cohort)
-    drop_over_120_age(cohort)
-    drop_under_16_age(cohort)
-    add_imd_bands(cohort)
-    add_ethnicity(cohort)
-    add_high_level_ethnicity(cohort)
-    add_missing_vacc_columns(cohort)
-    replace_unknown_dates(cohort)
-    add_vacc_dates(cohort)
-    add_earliest_decline_dates(cohort)
-    add_vacc_decline_dates(cohort)
-    add_vacc_any_record_dates(cohort)
+    input_cols = get_input_cols()
+    usecols = [fn for fn in fieldnames if fn in input_cols]
+    date_fieldnames = [fn for fn in usecols if fn.endswith("_dat")]
+    return usecols, date_fieldnames
+
+
+def get_input_cols():
+    """Return the names of all columns that `transform` might read.
+
+    The steps called by `transform` (and the helpers they call) refer to columns by
+    string literals, so we collect every string literal in their source.  This may
+    include a few strings that are not column names, but these are discarded when
+    they are matched against the header of the extract.
+    """
+
+    input_cols = set(necessary_cols)
+
+    # add_extra_at_risk_cols derives the names of the columns it reads
+    input_cols.update(col.replace("_group", "_dat") for col in extra_at_risk_cols)
+
+    # add_waves and add_groupings read the columns named in their rules
+    input_cols.update(wave_rule_cols)
+    for group, rule in group_rules:
+        input_cols.update(get_columns(rule))
+
+    for fn in get_called_functions(transform):
+        input_cols.update(get_string_literals(fn))
+
+    return input_cols
+
+
+def get_called_functions(fn, seen=None):
+    """Return `fn` and every module-level function it calls, recursively.
+
+    A function that is passed to another, as the steps of `transform` are passed to
+    run_step, is counted as called.  Functions from outside the analysis directory
+    are ignored.
+    """
+
+    if seen is None:
+        seen = []
+    if fn in seen:
+        return seen
+    seen.append(fn)
+
+    for node in ast.walk(parse_function(fn)):
+        if isinstance(node, ast.Name):
+            callee = fn.__globals__.get(node.id)
+            if inspect.isfunction(callee) and is_analysis_function(callee):
+                get_called_functions(callee, seen)
+
+    return seen
+
+
+def is_analysis_function(fn):
+    path = os.path.abspath(inspect.getsourcefile(fn))
+    return os.path.dirname(path) == os.path.dirname(os.path.abspath(__file__))
+
+
+def get_string_literals(fn):
+    return {
+        node.value
+        for node in ast.walk(parse_function(fn))
+        if isinstance(node, ast.Constant) and isinstance(node.value, str)
+    }
+
+
+def parse_function(fn):
+    return ast.parse(textwrap.dedent(inspect.getsource(fn)))
+
+
+def transform(cohort, attrition=None, checks=None):
+    """Transform data generated by study definition.
+
+    If `attrition` is given, the records excluded are counted in it (see
+    drop_exclusions), and if `checks` is given, the data-quality checks are gathered
+    in it (see data_checks.py).  Each step is run with run_step, which times it if
+    timing is enabled (see step_timings.py).
+    """
+
+    if checks is None:
+        checks = new_checks()
+
+    run_step("fast", check_dates, cohort, checks)
+    run_step("fast", drop_exclusions, cohort, attrition)
+    run_step("fast", add_imd_bands, cohort)
+    run_step("fast", add_ethnicity, cohort)
+    run_step("fast", add_high_level_ethnicity, cohort)
+    run_step("fast", add_missing_vacc_columns, cohort)
+    run_step("fast", replace_unknown_dates, cohort, checks)
+    run_step("fast", add_vacc_dates, cohort)
+    run_step("fast", add_earliest_decline_dates, cohort)
+    run_step("fast", add_vacc_decline_dates, cohort)
+    run_step("fast", add_vacc_any_record_dates, cohort)
     # The PRIMIS spec contains a number of overlapping age bands.  Bands 1 to 12 are
     # non-overlapping and we use these by default.  We can add other age bands as
     # required.
-    add_age_bands(cohort, range(1, 12 + 1))
-    add_groupings(cohort)
-    add_waves(cohort)
-    add_waves_2(cohort)
-    add_extra_at_risk_cols(cohort)
+    run_step("fast", add_age_bands, cohort, range(1, 12 + 1))
+    run_step("fast", add_groupings, cohort)
+    run_step("fast", add_waves, cohort)
+    run_step("fast", add_waves_2, cohort)
+    run_step("fast", add_extra_at_risk_cols, cohort)
+    run_step("fast", check_declines, cohort, checks)
     return cohort
 
 
-def drop_non_fm_sex(cohort):
-    """Drop records where sex is not F or M."""
+def drop_exclusions(cohort, attrition=None):
+    """Drop records that meet any of the exclusion criteria.
+
+    The criteria are evaluated into a single mask, so that the cohort is compacted
+    once.  If `attrition` is given, the number of records is added to
+    attrition["records"], and the number excluded by each criterion (and not by an
+    earlier one) to attrition[criterion].
+    """
+
+    keep = get_keep_mask(cohort, attrition)
+    cohort.drop(cohort.index[~keep], inplace=True)
+
+
+def get_keep_mask(cohort, attrition=None):
+    """Return a boolean array of the records that meet none of the exclusion
+    criteria, counting the records excluded by each as in drop_exclusions."""
+
+    if attrition is None:
+        attrition = {}
+    attrition["records"] = attrition.get("records", 0) + len(cohort)
+
+    keep = np.ones(len(cohort), dtype=bool)
+    for exclusion in [non_fm_sex, over_120_age, under_16_age]:
+        excluded = exclusion(cohort) & keep
+        criterion = exclusion.__name__
+        attrition[criterion] = attrition.get(criterion, 0) + int(excluded.sum())
+        keep &= ~excluded
+    return keep
+
 
-    ix = cohort[~cohort["sex"].isin(["F", "M"])].index
-    cohort.drop(ix, inplace=True)
+def non_fm_sex(cohort):
+    """Select records where sex is not F or M."""
 
+    return ~cohort["sex"].isin(["F", "M"]).values
 
-def drop_over_120_age(cohort):
-    """Drop records where age is >= 120.
+
+def over_120_age(cohort):
+    """Select records where age is >= 120.
 
     There are a handful of patients with a recorded date of birth of 1900-01-01.
     """
 
-    ix = cohort[cohort["age"] >= 120].index
-    cohort.drop(ix, inplace=True)
+    return cohort["age"].values >= 120
+
 
-def drop_under_16_age(cohort):
-    """Drop records where age is >16.
+def under_16_age(cohort):
+    """Select records where age is <16.
 
     Keep only over 16s eligible for vaccine.
     """
 
-    ix = cohort[cohort["age"] < 16].index
-    cohort.drop(ix, inplace=True)
+    return cohort["age"].values < 16
 
 
 def add_imd_bands(cohort):
     """Add IMD band from 1 (most deprived) to 5 (least deprived), or 0 if missing."""
 
-    cohort["imd_band"] = 0
-    s = cohort["imd_band"]
-
-    for band in range(1, 5 + 1):
-        s.mask(
-            ((band - 1) < cohort["imd"] * 5 / 32844)
-            & (cohort["imd"] * 5 / 32844 < band),
-            band,
-            inplace=True,
-        )
+    cohort["imd_band"] = imd_bands(cohort["imd"].values)
 
 
 def add_ethnicity(cohort):
@@ -143,29 +342,7 @@ def add_ethnicity(cohort):
 def add_high_level_ethnicity(cohort):
     """Add high-level ethnicity categories, based on bandings from PRIMIS spec."""
 
-    # Get mapping from category (1-16) to high-level category (1-5)
-    category_to_high_level_category = {}
-    with open("codelists/primis-covid19-vacc-uptake-eth2001.csv") as f:
-        for record in csv.DictReader(f):
-            category = int(record["grouping_16_id"])
-            high_level_category = int(record["grouping_6_id"])
-
-            if category in category_to_high_level_category:
-                assert category_to_high_level_category[category] == high_level_category
-            else:
-                category_to_high_level_category[category] = high_level_category
-
-    # Set high_level_ethnicity based on ethnicity column
-    cohort["high_level_ethnicity"] = np.nan
-    s = cohort["high_level_ethnicity"]
-
-    for category, high_level_category in category_to_high_level_category.items():
-        s.mask(cohort["ethnicity"] == category, high_level_category, inplace=True)
-
-    # For all other patients, set high_level_ethnicity to 6 (unknown)
-    s.mask(s.isna(), 6, inplace=True)
-
-    cohort["high_level_ethnicity"] = s.astype("int8")
+    cohort["high_level_ethnicity"] = high_level_ethnicities(cohort["ethnicity"].values)
 
 
 def add_missing_vacc_columns(cohort):
@@ -178,12 +355,17 @@ def add_missing_vacc_columns(cohort):
         cohort[col] = np.nan
 
 
-def replace_unknown_dates(cohort):
+def replace_unknown_dates(cohort, checks=None):
     """Where an event date was unknown (1900-01-01) or obviously incorrect (prior to vaccination campaign),
     replace with "2020-11-28". 
+
+    If `checks` is given, the number of dates replaced in each column is counted in it.
     """
     for col in ["cov1decl_dat", "cov2decl_dat", "covnot_dat", "covdecl_imms_dat", "covnot_imms_dat"]:
-        cohort.loc[cohort[col]<"2020-11-29", col] = datetime(2020,11,28)
+        unknown = notnull(cohort[col]) & lt(cohort[col], "2020-11-29")
+        cohort.loc[unknown, col] = datetime(2020,11,28)
+        if checks is not None:
+            count_rewritten_dates(checks, col, unknown)
 
     
 def add_vacc_dates(cohort):
@@ -222,59 +404,6 @@ def add_vacc_any_record_dates(cohort):
     cohort["vacc_any_record_dat"] = cohort[["vacc1_dat", "vacc2_dat", "covnot_dat", "covnot_imms_dat", "decl_dat"]].min(axis=1)
 
 
-def add_waves(cohort):
-    cohort["wave"] = 0
-    s = cohort["wave"]
-
-    # Wave 1: Residents in Care Homes
-    # (The spec includes staff in care homes, but occupation codes are not well
-    # recorded)
-    s.mask(
-        (cohort["longres_dat"].notnull()) & (cohort["age"] >= 65), 1, inplace=True
-    )
-
-    # Wave 2: Age 80 or over
-    # (This spec includes frontline H&SC workers, but see above.)
-    s.mask((s == 0) & (cohort["age"] >= 80), 2, inplace=True)
-
-    # Wave 3: Age 70 - 79 ## modified from original group for this study
-    s.mask((s == 0) & (cohort["age"] >= 70), 3, inplace=True)
-
-    # Wave 4: Clinically Extremely Vulnerable ## modified from original group for this study
-    s.mask(
-        (s == 0) & (cohort["shield_group"]), 4, inplace=True
-    )
-
-    # Wave 5: Age 65 - 69
-    s.mask((s == 0) & (cohort["age"] >= 65), 5, inplace=True)
-
-    # Wave 6: Age 16-64 in a defined At Risk group
-    s.mask(
-        (s == 0) & ((cohort["age"] >= 16) & cohort["atrisk_group"]), 6, inplace=True
-    )
-
-    # Wave 7: Age 60 - 64
-    s.mask((s == 0) & (cohort["age"] >= 60), 7, inplace=True)
-
-    # Wave 8: Age 55 - 59
-    s.mask((s == 0) & (cohort["age"] >= 55), 8, inplace=True)
-
-    # Wave 9: Age 50 - 54
-    s.mask((s == 0) & (cohort["age"] >= 50), 9, inplace=True)
-
-def add_waves_2(cohort):
-    cohort["wave2"] = 0
-    s = cohort["wave2"]
-
-    # Wave 2.1: Residents in Care Homes and those over 65 (waves 1-3 & 5)
-    s.mask(cohort["wave"].isin([1,2,3,5]), 1, inplace=True)
-
-    # Wave 2.2: CEV (aged 16-69) and At Risk (aged 16-64)
-    s.mask((s == 0) & cohort["wave"].isin([4,6]), 2, inplace=True)
-
-    # Wave 2.3: 50-64
-    s.mask((s == 0) & cohort["wave"].isin([7,8,9]), 3, inplace=True)
-
 def add_extra_at_risk_cols(cohort):
     """Add columns for extra at-risk groups."""
 
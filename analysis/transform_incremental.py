@@ -0,0 +1,277 @@
+"""Update a stored cohort from a new extract, transforming only the patients whose
+rows have changed.
+
+Successive extracts are mostly the same, and the transform treats each patient
+independently, so we can compare the new extract with the previous one, line by
+line, and transform only the patients whose lines are new or different.  The
+results are merged into the cohort built from the previous extract, which gives the
+same cohort as transforming the whole of the new extract.
+
+This is only safe if the stored cohort was built from the previous extract, by the
+same code, with the same options.  So when a cohort is written here, we record a
+key for the extract, code and options (see transform_cache.py) in its manifest, and
+we fall back to transforming the whole extract if the key does not match, or if the
+extracts have different headers.
+
+As in transform_slow.get_shards, this assumes that no field contains a newline.
+"""
+
+import csv
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import transform_cache, transform_fast, transform_slow
+from cohort_store import (
+    get_source,
+    load_cohort,
+    load_manifest,
+    record_source,
+    write_attrition,
+    write_checks,
+    write_cohort,
+)
+from data_checks import new_checks
+from transform_fast import necessary_cols
+
+
+def run(
+    engine,
+    input_path,
+    previous_input_path,
+    output_path,
+    chunksize=None,
+    workers=1,
+    compact_dates=False,
+    packed_groups=False,
+):
+    """Update the cohort at `output_path`, built by `engine` ("fast" or "slow") from
+    the extract at `previous_input_path`, to match the extract at `input_path`.
+
+    If the cohort was not built from the previous extract (or there is no previous
+    extract), or the merged cohort cannot be given the dtypes of a full run, the
+    whole of the new extract is transformed.  Return the number of patients that
+    were transformed.
+    """
+
+    options = {"compact_dates": compact_dates, "packed_groups": packed_groups}
+    key = get_source_key(engine, input_path, options)
+
+    changes = None
+    previous_key = get_source_key(engine, previous_input_path, options)
+    if previous_key is not None and get_source(output_path) == previous_key:
+        changes = get_changes(input_path, previous_input_path)
+
+    if changes is None:
+        return transform_whole(engine, input_path, output_path, key, chunksize, workers, options)
+
+    header, patient_ids, changed_ids, changed_lines = changes
+    previous_cohort = load_cohort(output_path)
+    schema = {column["name"]: column for column in load_manifest(output_path)["columns"]}
+
+    delta = None
+    if changed_lines:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            delta_path = os.path.join(tmpdir, "delta.csv")
+            with open(delta_path, "w") as f:
+                f.write(header)
+                f.writelines(changed_lines)
+            delta = transform_file(engine, delta_path, chunksize, workers)
+
+    cohort = merge(engine, previous_cohort, delta, patient_ids, changed_ids, schema)
+    if cohort is None:
+        return transform_whole(engine, input_path, output_path, key, chunksize, workers, options)
+
+    write_cohort(cohort, output_path, **options)
+    write_attrition(output_path, get_attrition(input_path))
+    # The checks would need the whole extract, so the data-quality checks of the
+    # previous extract are removed, and the check actions compute their own
+    write_checks(output_path, None)
+    record_source(output_path, key)
+    return len(changed_lines)
+
+
+def transform_whole(engine, input_path, output_path, key, chunksize, workers, options):
+    attrition = {}
+    checks = new_checks() if engine == "fast" else None
+    cohort = transform_file(engine, input_path, chunksize, workers, attrition, checks)
+    write_cohort(cohort, output_path, **options)
+    write_attrition(output_path, attrition)
+    write_checks(output_path, checks)
+    record_source(output_path, key)
+    return len(cohort)
+
+
+def get_source_key(engine, input_path, options):
+    if input_path is None or not os.path.exists(input_path):
+        return None
+    return transform_cache.get_key(
+        input_path, dict(options, engine=engine), [transform_fast, transform_slow]
+    )
+
+
+def transform_file(engine, input_path, chunksize, workers, attrition=None, checks=None):
+    if engine == "fast":
+        return transform_fast.transform_file(input_path, chunksize, attrition, checks)
+    else:
+        return transform_slow.transform_file(input_path, workers, attrition)
+
+
+def get_attrition(input_path):
+    """Return the attrition of the whole extract.
+
+    The attrition of the delta only covers the changed patients, so the exclusions
+    are evaluated again over the whole extract, which needs only the columns that
+    they read.
+    """
+
+    attrition = {}
+    transform_fast.get_keep_mask(pd.read_csv(input_path, usecols=["sex", "age"]), attrition)
+    return attrition
+
+
+def get_changes(input_path, previous_input_path):
+    """Compare two extracts, and return:
+
+        * the header of the new extract
+        * the patient_ids in the new extract, in order
+        * the set of patient_ids whose lines are new or have changed
+        * those lines, in order
+
+    or None if the extracts have different headers.
+    """
+
+    previous_header, previous_lines = read_lines_by_patient(previous_input_path)
+    # Hashes take less memory than lines, and the lines are only compared within
+    # this process
+    previous_hashes = {patient_id: hash(line) for patient_id, line in previous_lines}
+    del previous_lines
+
+    header, lines = read_lines_by_patient(input_path)
+    if header != previous_header:
+        return None
+
+    patient_ids = []
+    changed_ids = set()
+    changed_lines = []
+    for patient_id, line in lines:
+        patient_ids.append(patient_id)
+        if previous_hashes.get(patient_id) != hash(line):
+            changed_ids.add(patient_id)
+            changed_lines.append(line)
+
+    return header, patient_ids, changed_ids, changed_lines
+
+
+def read_lines_by_patient(input_path):
+    """Return the header of the extract, and an iterator over (patient_id, line)
+    pairs, with patient_id as an int."""
+
+    with open(input_path) as f:
+        header = f.readline()
+    position = next(csv.reader([header])).index("patient_id")
+
+    def iter_lines():
+        # Read the file twice, once to parse and once for the raw lines, so that
+        # each line is parsed by the same csv.reader
+        with open(input_path) as f_lines, open(input_path) as f_records:
+            reader = csv.reader(f_records)
+            next(f_lines)
+            next(reader)
+            for line, record in zip(f_lines, reader):
+                if not line.endswith("\n"):
+                    line += "\n"
+                yield int(record[position]), line
+
+    return header, iter_lines()
+
+
+def merge(engine, previous_cohort, delta, patient_ids, changed_ids, schema):
+    """Return the cohort for the new extract, taking unchanged patients from the
+    previous cohort and changed patients from the delta, or None if the columns
+    cannot be given the dtypes of a full run (see get_dtypes).
+
+    Patients are in the order of the new extract, with the index that the engine
+    would give them: for the fast engine, the position of the patient's row in the
+    extract, and for the slow engine, a range.
+    """
+
+    positions = pd.Series(np.arange(len(patient_ids)), index=patient_ids)
+    assert positions.index.is_unique
+
+    previous_ids = previous_cohort["patient_id"]
+    keep = previous_ids.isin(positions.index) & ~previous_ids.isin(list(changed_ids))
+    kept = previous_cohort[keep]
+    parts = [kept]
+    if delta is not None and len(delta):
+        parts.append(delta)
+    cohort = pd.concat(parts)[necessary_cols]
+
+    dtypes = get_dtypes(kept, delta, schema)
+    if dtypes is None:
+        return None
+    for col, dtype in dtypes.items():
+        if cohort[col].dtype == dtype:
+            continue
+        cast = cast_exactly(cohort[col], dtype)
+        if cast is None:
+            return None
+        cohort[col] = cast
+
+    cohort_positions = positions[cohort["patient_id"].values].values
+    order = np.argsort(cohort_positions, kind="stable")
+    cohort = cohort.iloc[order]
+
+    if engine == "fast":
+        cohort.index = pd.Index(cohort_positions[order])
+    else:
+        cohort.index = pd.RangeIndex(len(cohort))
+    return cohort
+
+
+def get_dtypes(kept, delta, schema):
+    """Return the dtype that a full run would give each column, or None if it cannot
+    be told.
+
+    Some columns have the dtype that pd.read_csv would give their values, so that,
+    for instance, a column of whole numbers is int64, unless a value is missing,
+    when it is float64.  So the dtype of a full run is the wider of the dtypes of the
+    kept patients' values and of the delta.  The delta has its own dtypes, but the
+    kept patients' values were stored with the dtypes recorded in the schema, which
+    they may now be narrower than, if the patients that made a column wider have
+    changed or been removed.  If there is no delta, a float64 column whose kept
+    values are all whole numbers is int64, as pd.read_csv would make it.
+    """
+
+    has_delta = delta is not None and len(delta)
+    dtypes = {}
+    for col in necessary_cols:
+        dtype = np.dtype(schema[col]["dtype"])
+        if has_delta and delta[col].dtype != dtype:
+            delta_dtype = delta[col].dtype
+            if np.can_cast(dtype, delta_dtype):
+                dtype = delta_dtype
+            elif not np.can_cast(delta_dtype, dtype):
+                return None
+            elif cast_exactly(kept[col], delta_dtype) is not None:
+                dtype = delta_dtype
+        elif not has_delta and dtype == np.float64 and len(kept):
+            if cast_exactly(kept[col], np.dtype(np.int64)) is not None:
+                dtype = np.dtype(np.int64)
+        dtypes[col] = dtype
+    return dtypes
+
+
+def cast_exactly(values, dtype):
+    """Return `values` cast to `dtype`, or None if the cast would change them."""
+
+    try:
+        cast = values.astype(dtype)
+    except (TypeError, ValueError):
+        return None
+    same = (cast.values == values.values) | (pd.isnull(cast.values) & pd.isnull(values.values))
+    if not same.all():
+        return None
+    return cast
@@ -1,319 +1,566 @@
 import csv
-from tempfile import NamedTemporaryFile
+import os
+from bisect import bisect_right
+from multiprocessing import Pool
 
+import numpy as np
 import pandas as pd
 
-from age_bands import age_bands
-from add_groupings_2 import add_groupings_2
+import step_timings
+from add_groupings_2 import compile_add_groupings_2, groups
+from bandings import get_age_band_lookup, get_high_level_ethnicity_lookup, imd_band
+from cohort_store import write_attrition, write_checks, write_cohort
+from row_access import get_index, make_getter
 from transform_fast import extra_at_risk_cols, extra_vacc_cols, necessary_cols
+from waves import wave_rules, wave_to_wave2
 
 necessary_cols.extend(["cov1decl_dat", "cov2decl_dat"])
 
-# Get mapping from category (1-16) to high-level category (1-5)
-category_to_high_level_category = {}
-with open("codelists/primis-covid19-vacc-uptake-eth2001.csv") as f:
-    for record in csv.DictReader(f):
-        category = int(record["grouping_16_id"])
-        high_level_category = int(record["grouping_6_id"])
+date_fieldnames = [
+    fn for fn in necessary_cols if fn.endswith("_dat") and fn not in extra_vacc_cols
+]
+
+dtypes = {
+    "ethnicity": "int8",
+    "high_level_ethnicity": "int8",
+}
+
+
+def run(
+    input_path="output/input.csv",
+    output_path="output/cohort",
+    workers=1,
+    compact_dates=False,
+    packed_groups=False,
+):
+    """Transform the input, using `workers` processes (or one per core if `workers`
+    is less than 1).
+    """
 
-        if category in category_to_high_level_category:
-            assert category_to_high_level_category[category] == high_level_category
-        else:
-            category_to_high_level_category[category] = high_level_category
+    attrition = {}
+    cohort = transform_file(input_path, workers, attrition)
+    write_cohort(
+        cohort, output_path, compact_dates=compact_dates, packed_groups=packed_groups
+    )
+    write_attrition(output_path, attrition)
+    # The data-quality checks are only gathered by transform_fast
+    write_checks(output_path, None)
+
+
+def transform_file(input_path, workers=1, attrition=None):
+    """Return the cohort transformed from the input, using `workers` processes (or
+    one per core if `workers` is less than 1), and counting the records excluded in
+    `attrition` if given (see transform_rows)."""
+
+    if attrition is None:
+        attrition = {}
+
+    if workers < 1:
+        workers = os.cpu_count()
 
+    if workers > 1:
+        return transform_sharded(input_path, workers, attrition)
 
-def run(input_path="output/input.csv", output_path="output/cohort.pickle"):
     with open(input_path) as f:
-        reader = csv.DictReader(f)
-        cohort = transform(reader)
-    cohort.to_pickle(output_path)
-
-
-def transform(reader):
-    with NamedTemporaryFile("w+") as f:
-        writer = csv.DictWriter(f, necessary_cols)
-        writer.writeheader()
-        for row in transform_rows(reader):
-            writer.writerow(row)
-
-        f.seek(0)
-
-        # We set parse_dates and dtype to ensure that the returned dataframe is
-        # identical to that returned by the original transform.
-        date_fieldnames = [
-            fn
-            for fn in necessary_cols
-            if fn.endswith("_dat") and fn not in extra_vacc_cols
-        ]
-        dtypes = {
-            "ethnicity": "int8",
-            "high_level_ethnicity": "int8",
-        }
-        cohort = pd.read_csv(f.name, parse_dates=date_fieldnames, dtype=dtypes)
+        reader = csv.reader(f)
+        return transform(reader, attrition)
+
+
+def transform_sharded(input_path, workers, attrition):
+    """Transform the input in parallel, with one shard of the file per worker."""
+
+    with open(input_path) as f:
+        fieldnames = next(csv.reader(f))
+
+    shards = get_shards(input_path, workers)
+    timed = step_timings.is_enabled()
+    with Pool(workers) as pool:
+        results = pool.starmap(
+            transform_shard,
+            [(input_path, fieldnames, start, end, timed) for start, end in shards],
+        )
+
+    blocks = []
+    for block, timings, shard_attrition in results:
+        blocks.append(block)
+        step_timings.add(timings)
+        for criterion, count in shard_attrition.items():
+            attrition[criterion] = attrition.get(criterion, 0) + count
+
+    # Each block is in patient order, and the blocks are in the order of the shards.
+    with step_timings.timed("slow", "build_cohort"):
+        cohort = pd.concat([pd.DataFrame(block) for block in blocks], ignore_index=True)
+    return cohort[necessary_cols]
+
+
+def get_shards(input_path, n):
+    """Split the body of the file into at most n byte ranges of roughly equal size.
+
+    Each range starts at the beginning of a line and ends at the beginning of
+    another, so no row is split between two shards.  This assumes that no field
+    contains a newline, which holds for files written by cohortextractor.
+    """
+
+    size = os.path.getsize(input_path)
+    with open(input_path, "rb") as f:
+        f.readline()
+        offsets = [f.tell()]
+        for ix in range(1, n):
+            f.seek(max(offsets[0] + (size - offsets[0]) * ix // n, offsets[-1]))
+            if f.tell() > offsets[0]:
+                # Skip to the start of the next line
+                f.readline()
+            offsets.append(min(f.tell(), size))
+        offsets.append(size)
+
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if start < end]
+
+
+def transform_shard(input_path, fieldnames, start, end, timed=False):
+    """Return the columns transformed from a shard of the file, the timings of the
+    steps if `timed` is True, and the attrition of the shard."""
+
+    if timed:
+        step_timings.enable()
+    attrition = {}
+    reader = csv.reader(read_lines(input_path, start, end))
+    with step_timings.timed("slow", "transform_rows"):
+        rows = transform_rows(reader, fieldnames, attrition)
+        columns = collect_columns(rows, fieldnames)
+    return columns, step_timings.collect(), attrition
+
+
+def read_lines(input_path, start, end):
+    """Yield the lines of the file between two byte offsets."""
+
+    with open(input_path, "rb") as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            position += len(line)
+            yield line.decode("utf8")
+
+
+def transform(reader, attrition=None):
+    """Transform the rows of a csv.reader, the first of which is the header."""
+
+    fieldnames = next(reader)
+    with step_timings.timed("slow", "transform_rows"):
+        rows = transform_rows(reader, fieldnames, attrition)
+        columns = collect_columns(rows, fieldnames)
+    with step_timings.timed("slow", "build_cohort"):
+        return build_cohort(columns)
+
+
+def get_layout(fieldnames):
+    """Return the names of the values in a transformed row, in order.
+
+    A transformed row has the values from the input, followed by the values that the
+    transform adds, followed by empty values for any other necessary columns.
+    """
+
+    derived_cols = (
+        ["imd_band", "ethnicity", "high_level_ethnicity"]
+        + missing_vacc_cols
+        + ["vacc1_dat", "vacc2_dat", "decl_first_dat", "decl_dat"]
+        + ["vacc_any_record_dat", "age_band"]
+        + groups
+        + ["wave", "wave2"]
+        + extra_at_risk_cols
+    )
+    return list(dict.fromkeys(fieldnames + derived_cols + necessary_cols))
+
+
+def collect_columns(rows, fieldnames):
+    """Append the values of each row to a buffer per column, and convert each buffer
+    to an array.
+
+    Columns that the transform did not set get an empty value, as they would if the
+    row were written with a csv.DictWriter.
+    """
+
+    index = get_index(get_layout(fieldnames))
+    columns = {fn: [] for fn in necessary_cols}
+    buffers = [(values, index[fn]) for fn, values in columns.items()]
+    for row in rows:
+        for values, ix in buffers:
+            values.append(row[ix])
+    return {fn: build_column(fn, values) for fn, values in columns.items()}
+
+
+def build_cohort(columns):
+    cohort = pd.DataFrame(columns)
     return cohort[necessary_cols]
 
 
-def transform_rows(rows):
-    for ix, row in enumerate(rows):
-        if non_fm_sex(row):
+def build_column(fn, values):
+    """Convert a buffer of row values into an array.
+
+    We set the dtype to ensure that the returned dataframe is identical to that
+    returned by the original transform, which is the dtype that pd.read_csv would
+    give the column if the values were written to a CSV file and read back in.
+    """
+
+    if fn in date_fieldnames:
+        # numpy parses "" as NaT
+        return np.array(values, dtype="datetime64[ns]")
+
+    if fn in dtypes:
+        return np.array(values, dtype=dtypes[fn])
+
+    array = pd.Series(values).values
+    if array.dtype != object:
+        return array
+
+    # The values are strings, which pd.read_csv would convert to numbers if it could
+    array[array == ""] = np.nan
+    try:
+        return pd.to_numeric(array)
+    except (ValueError, TypeError):
+        return array
+
+
+def transform_rows(rows, fieldnames, attrition=None):
+    """Transform rows, each a list of values in the order of `fieldnames`.
+
+    The position of each column is resolved once, when the steps are compiled, so
+    that each step can get and set values by position.  Each row is extended with
+    empty values for the columns that the steps add.  The age is replaced by an int.
+
+    If `attrition` is given, the number of rows is added to attrition["records"],
+    and the number excluded by each exclusion (and not by an earlier one) to
+    attrition[exclusion], once all the rows have been transformed.
+
+    If timing is enabled, each step, and each exclusion, is timed (see
+    step_timings.py).
+    """
+
+    layout = get_layout(fieldnames)
+    index = get_index(layout)
+    blank = [""] * (len(layout) - len(fieldnames))
+
+    sex_ix = index["sex"]
+    age_ix = index["age"]
+
+    for fn in missing_vacc_cols:
+        assert fn not in fieldnames, fn
+
+    steps = [
+        compile_add_imd_bands(index),
+        compile_add_ethnicity(index),
+        compile_add_high_level_ethnicity(index),
+        compile_replace_unknown_dates(index),
+        compile_add_vacc_dates(index),
+        compile_add_earliest_decline_dates(index),
+        compile_add_vacc_decline_dates(index),
+        compile_add_vacc_any_record_dates(index),
+        compile_add_age_bands(index, range(1, 12 + 1)),
+        compile_add_groupings_2(index),
+        compile_add_waves(index),
+        compile_add_waves_2(index),
+        compile_add_extra_at_risk_cols(index, fieldnames),
+    ]
+    exclusions = [non_fm_sex, over_120_age, under_16_age]
+
+    if step_timings.is_enabled():
+        exclusions = [
+            step_timings.time_row_exclusion("slow", exclusion) for exclusion in exclusions
+        ]
+        steps = [step_timings.time_row_step("slow", step) for step in steps]
+    is_non_fm_sex, is_over_120_age, is_under_16_age = exclusions
+
+    # The number of rows, and the number excluded by each exclusion
+    counts = [0, 0, 0, 0]
+
+    for row in rows:
+        counts[0] += 1
+        if is_non_fm_sex(row[sex_ix]):
+            counts[1] += 1
             continue
-        if over_120_age(row):
+        age = int(row[age_ix])
+        if is_over_120_age(age):
+            counts[2] += 1
             continue
-        if under_16_age(row):
+        if is_under_16_age(age):
+            counts[3] += 1
             continue
 
-        add_imd_bands(row)
-        add_ethnicity(row)
-        add_high_level_ethnicity(row)
-        add_missing_vacc_columns(row)
-        replace_unknown_dates(row)
-        add_vacc_dates(row)
-        add_earliest_decline_dates(row)
-        add_vacc_decline_dates(row)
-        add_vacc_any_record_dates(row)
-        add_age_bands(row, range(1, 12 + 1))
-        add_groupings_2(row)
-        add_waves(row)
-        add_waves_2(row)
-        add_extra_at_risk_cols(row)
-        row = {k: v for k, v in row.items() if k in necessary_cols}
+        row[age_ix] = age
+        row.extend(blank)
+        for step in steps:
+            step(row)
         yield row
 
+    if attrition is not None:
+        criteria = ["records", "non_fm_sex", "over_120_age", "under_16_age"]
+        for criterion, count in zip(criteria, counts):
+            attrition[criterion] = attrition.get(criterion, 0) + count
+
 
-def non_fm_sex(row):
+def non_fm_sex(sex):
     """Return True if sex is not F or M."""
 
-    return row["sex"] not in ["F", "M"]
+    return sex not in ["F", "M"]
 
 
-def over_120_age(row):
+def over_120_age(age):
     """Return True if age is >= 120.
 
     There are a handful of patients with a recorded date of birth of 1900-01-01.
     """
 
-    return int(row["age"]) >= 120
+    return age >= 120
 
-def under_16_age(row):
+def under_16_age(age):
     """Return True if age is < 16.
 
     """
 
-    return int(row["age"]) < 16
+    return age < 16
 
-def add_imd_bands(row):
+def compile_add_imd_bands(index):
     """Add IMD band from 1 (most deprived) to 5 (least deprived), or 0 if missing."""
 
-    if not row["imd"]:
-        row["imd_band"] = 0
-        return
+    imd_ix = index["imd"]
+    imd_band_ix = index["imd_band"]
 
-    for band in range(1, 5 + 1):
-        if int(row["imd"]) < band * 32844 / 5:
-            row["imd_band"] = band
+    def add_imd_bands(row):
+        if not row[imd_ix]:
+            row[imd_band_ix] = 0
             return
 
+        band = imd_band(int(row[imd_ix]))
+        if band is not None:
+            row[imd_band_ix] = band
 
-def add_ethnicity(row):
+    return add_imd_bands
+
+
+def compile_add_ethnicity(index):
     """Add ethnicity using bandings from PRIMIS spec."""
 
-    if row["eth2001"]:
-        # eth2001 already indicates whether a patient is in any of bands 1-16
-        row["ethnicity"] = int(row["eth2001"])
+    eth2001_ix = index["eth2001"]
+    non_eth2001_dat_ix = index["non_eth2001_dat"]
+    eth_notgiptref_dat_ix = index["eth_notgiptref_dat"]
+    eth_notstated_dat_ix = index["eth_notstated_dat"]
+    ethnicity_ix = index["ethnicity"]
 
-    elif row["non_eth2001_dat"]:
-        # Add band 17 (Patients with any other ethnicity code)
-        row["ethnicity"] = 17
+    def add_ethnicity(row):
+        if row[eth2001_ix]:
+            # eth2001 already indicates whether a patient is in any of bands 1-16
+            row[ethnicity_ix] = int(row[eth2001_ix])
 
-    elif row["eth_notgiptref_dat"]:
-        # Add band 18 (Ethnicity not given - patient refused)
-        row["ethnicity"] = 18
+        elif row[non_eth2001_dat_ix]:
+            # Add band 17 (Patients with any other ethnicity code)
+            row[ethnicity_ix] = 17
 
-    elif row["eth_notstated_dat"]:
-        # Add band 19 (Ethnicity not stated)
-        row["ethnicity"] = 19
+        elif row[eth_notgiptref_dat_ix]:
+            # Add band 18 (Ethnicity not given - patient refused)
+            row[ethnicity_ix] = 18
 
-    else:
-        # Add band 20 (Ethnicity not recorded)
-        row["ethnicity"] = 20
+        elif row[eth_notstated_dat_ix]:
+            # Add band 19 (Ethnicity not stated)
+            row[ethnicity_ix] = 19
 
+        else:
+            # Add band 20 (Ethnicity not recorded)
+            row[ethnicity_ix] = 20
+
+    return add_ethnicity
 
-def add_high_level_ethnicity(row):
+
+def compile_add_high_level_ethnicity(index):
     """Add high-level ethnicity categories, based on bandings from PRIMIS spec."""
 
-    # Set high_level_ethnicity based on ethnicity column
-    row["high_level_ethnicity"] = category_to_high_level_category.get(
-        row["ethnicity"], 6  # 6 is "unknown"
-    )
+    ethnicity_ix = index["ethnicity"]
+    high_level_ethnicity_ix = index["high_level_ethnicity"]
+    lookup = get_high_level_ethnicity_lookup().tolist()
 
+    def add_high_level_ethnicity(row):
+        # Set high_level_ethnicity based on ethnicity column
+        ethnicity = row[ethnicity_ix]
+        if 0 <= ethnicity < len(lookup):
+            row[high_level_ethnicity_ix] = lookup[ethnicity]
+        else:
+            row[high_level_ethnicity_ix] = 6  # 6 is "unknown"
+
+    return add_high_level_ethnicity
 
-def add_missing_vacc_columns(row):
-    """Add columns for vaccines that are not yet available but which are referenced by
-    the spec.
-    """
 
-    for prefix in ["mo", "nx", "jn", "gs", "vl"]:
-        assert f"{prefix}d1rx_dat" not in row
-        assert f"{prefix}d2rx_dat" not in row
-        row[f"{prefix}d1rx_dat"] = ""
-        row[f"{prefix}d2rx_dat"] = ""
+# Columns for vaccines that are not yet available but which are referenced by the
+# spec.  These are always empty.
+missing_vacc_cols = [
+    f"{prefix}d{ix}rx_dat" for prefix in ["mo", "nx", "jn", "gs", "vl"] for ix in [1, 2]
+]
 
 
-def replace_unknown_dates(row):
+def compile_replace_unknown_dates(index):
     """Where an event date was unknown (1900-01-01) or obviously incorrect (prior to vaccination campaign),
     replace with "2020-11-28". 
     """
-    for col in ["cov1decl_dat", "cov2decl_dat", "covdecl_imms_dat", "covnot_dat", "covnot_imms_dat"]:
-        d = row[col]
-        
-        if (d is not None) & (d != ""):
-            if d < "2020-11-29":
-                row[col] = "2020-11-28"
+
+    positions = [
+        index[col]
+        for col in [
+            "cov1decl_dat",
+            "cov2decl_dat",
+            "covdecl_imms_dat",
+            "covnot_dat",
+            "covnot_imms_dat",
+        ]
+    ]
+
+    def replace_unknown_dates(row):
+        for ix in positions:
+            d = row[ix]
+            if d and d < "2020-11-29":
+                row[ix] = "2020-11-28"
+
+    return replace_unknown_dates
 
 
-def add_vacc_dates(row):
+def compile_add_vacc_dates(index):
     """Record earliest date of first and second vaccinations.
 
     In some cases, a patient will have only one covadm1/2_dat and covrx1/2_dat.
     """
-    covsnomed_dat = row["covsnomed_dat"]
-    for ix in 1, 2:
-        covadm_dat = row[f"covadm{ix}_dat"]
-        covrx_dat = row[f"covrx{ix}_dat"]
-        vacc_dat_fn = f"vacc{ix}_dat"
-
-        if ix==1:
-            dates = [covadm_dat, covsnomed_dat, covrx_dat]
-        else:
-            dates = [covadm_dat, covrx_dat]
-            
-        actual_dates = [date for date in dates if date]
-            
-        if actual_dates:
-            row[vacc_dat_fn] = min(actual_dates)
-        else:
-            row[vacc_dat_fn] = ""
 
-def add_earliest_decline_dates(row):
+    vacc1_getter = make_getter(index, ["covadm1_dat", "covsnomed_dat", "covrx1_dat"])
+    vacc2_getter = make_getter(index, ["covadm2_dat", "covrx2_dat"])
+    vacc1_dat_ix = index["vacc1_dat"]
+    vacc2_dat_ix = index["vacc2_dat"]
+
+    def add_vacc_dates(row):
+        row[vacc1_dat_ix] = earliest(vacc1_getter(row))
+        row[vacc2_dat_ix] = earliest(vacc2_getter(row))
+
+    return add_vacc_dates
+
+
+def compile_add_earliest_decline_dates(index):
     """Record earliest date of a decline (irrespective of vaccination status).
     """
 
-    dates = [row["cov1decl_dat"], row["cov2decl_dat"], row["covdecl_imms_dat"]]
-    actual_dates = [date for date in dates if date]
-    
-    if actual_dates:
-        row["decl_first_dat"] = min(actual_dates)
-    else:
-        row["decl_first_dat"] = ""
+    getter = make_getter(index, ["cov1decl_dat", "cov2decl_dat", "covdecl_imms_dat"])
+    decl_first_dat_ix = index["decl_first_dat"]
 
+    def add_earliest_decline_dates(row):
+        row[decl_first_dat_ix] = earliest(getter(row))
 
-def add_vacc_decline_dates(row):
+    return add_earliest_decline_dates
+
+
+def compile_add_vacc_decline_dates(index):
     """Record decline only if patient has had no vaccine recorded.
     """
-    row["decl_dat"] = row["decl_first_dat"]
 
-    # Replace declined date with null if a vaccine has been recorded
-    if row["vacc1_dat"]:
-        row["decl_dat"] = ""
+    decl_first_dat_ix = index["decl_first_dat"]
+    vacc1_dat_ix = index["vacc1_dat"]
+    decl_dat_ix = index["decl_dat"]
+
+    def add_vacc_decline_dates(row):
+        # Replace declined date with null if a vaccine has been recorded
+        if row[vacc1_dat_ix]:
+            row[decl_dat_ix] = ""
+        else:
+            row[decl_dat_ix] = row[decl_first_dat_ix]
 
+    return add_vacc_decline_dates
 
-def add_vacc_any_record_dates(row):
+
+def compile_add_vacc_any_record_dates(index):
     """Date at which patient went from unvaccinated to vaccinated, 
     OR had any record related to vaccine refusal, contraindications etc. 
     """
-    dates = [row["vacc1_dat"], row["vacc2_dat"], row["covnot_dat"], row["covnot_imms_dat"], row["decl_dat"]]
-    actual_dates = [date for date in dates if date]
-    
-    if actual_dates:
-        row["vacc_any_record_dat"] =  min(actual_dates)
-    else:
-        row["vacc_any_record_dat"] = ""
 
+    getter = make_getter(
+        index, ["vacc1_dat", "vacc2_dat", "covnot_dat", "covnot_imms_dat", "decl_dat"]
+    )
+    vacc_any_record_dat_ix = index["vacc_any_record_dat"]
 
-def add_age_bands(row, bands):
-    for band in bands:
-        lower, upper = age_bands[band]
-        if lower is None:
-            lower = -1
-        if upper is None:
-            upper = 999
-        if lower <= int(row["age"]) < upper:
-            row["age_band"] = band
-            return
+    def add_vacc_any_record_dates(row):
+        row[vacc_any_record_dat_ix] = earliest(getter(row))
 
-    assert False
+    return add_vacc_any_record_dates
 
 
-def add_waves(row):
-    age = int(row["age"])
+def earliest(dates):
+    """Return the earliest of the non-empty dates, or "" if they are all empty."""
 
-    if row["longres_dat"] and age >= 65:
-        # Wave 1: Residents in Care Homes
-        # (The spec includes staff in care homes, but occupation codes are not well
-        # recorded)
-        row["wave"] = 1
+    actual_dates = [date for date in dates if date]
+    if actual_dates:
+        return min(actual_dates)
+    else:
+        return ""
 
-    elif age >= 80:
-        # Wave 2: Age 80 or over
-        # (This spec includes frontline H&SC workers, but see above.)
-        row["wave"] = 2
 
-    elif 70 <= age <= 79:
-        # Wave 3: Age 70 - 79
-        row["wave"] = 3
+def compile_add_age_bands(index, bands):
+    age_ix = index["age"]
+    age_band_ix = index["age_band"]
+    boundaries, lookup = get_age_band_lookup(tuple(bands))
+    lookup = lookup.tolist()
 
-    elif row["shield_group"]:
-        # Wave 4: Clinically Extremely Vulnerable
-        row["wave"] = 4
+    def add_age_bands(row):
+        band = lookup[bisect_right(boundaries, row[age_ix])]
+        assert band
+        row[age_band_ix] = band
 
-    elif 65 <= age <= 69:
-        # Wave 5: Age 65 - 69
-        row["wave"] = 5
+    return add_age_bands
 
-    elif (16 <= age <= 64) and row["atrisk_group"]:
-        # Wave 6: Age 16-64 in a defined At Risk group
-        row["wave"] = 6
 
-    elif 60 <= age <= 64:
-        # Wave 7: Age 60 - 64
-        row["wave"] = 7
+def compile_add_waves(index):
+    """Add the wave, from the rules in waves.py."""
 
-    elif 55 <= age <= 59:
-        # Wave 8: Age 55 - 59
-        row["wave"] = 8
+    age_ix = index["age"]
+    wave_ix = index["wave"]
 
-    elif 50 <= age <= 54:
-        # Wave 9: Age 50 - 54
-        row["wave"] = 9
+    rules = []
+    for wave, column, lower, upper in wave_rules:
+        if lower is None:
+            lower = -1
+        if upper is None:
+            upper = 999
+        rules.append((wave, None if column is None else index[column], lower, upper))
 
-    else:
-        row["wave"] = 0
+    def add_waves(row):
+        age = row[age_ix]
+        for wave, ix, lower, upper in rules:
+            if lower <= age < upper and (ix is None or row[ix]):
+                row[wave_ix] = wave
+                return
 
+        row[wave_ix] = 0
 
-def add_waves_2(row):
+    return add_waves
 
-    # Wave 2.1: Residents in Care Homes and those over 65 (waves 1-3 & 5)
-    if row["wave"] in [1,2,3,5]:
-        row["wave2"] = 1
 
-    # Wave 2.2: CEV (aged 16-69) and At Risk (aged 16-64)
-    elif row["wave"] in [4,6]:
-        row["wave2"] = 2
+def compile_add_waves_2(index):
+    """Add the combined wave, from the mapping in waves.py."""
 
-    # Wave 2.3: 50-64
-    elif row["wave"] in [7,8,9]:
-        row["wave2"] = 3
+    wave_ix = index["wave"]
+    wave2_ix = index["wave2"]
 
-    else:
-        row["wave2"] = 0
+    def add_waves_2(row):
+        row[wave2_ix] = wave_to_wave2.get(row[wave_ix], 0)
+
+    return add_waves_2
 
-def add_extra_at_risk_cols(row):
+
+def compile_add_extra_at_risk_cols(index, fieldnames):
     """Add columns for extra at-risk groups."""
 
+    positions = []
     for col in extra_at_risk_cols:
         date_col = col.replace("_group", "_dat")
-        if date_col in row:
-            row[col] = bool(row[date_col])
+        if date_col in fieldnames:
+            positions.append((index[col], index[date_col]))
+
+    def add_extra_at_risk_cols(row):
+        for ix, date_ix in positions:
+            row[ix] = bool(row[date_ix])
+
+    return add_extra_at_risk_cols
 
 
 if __name__ == "__main__":
@@ -0,0 +1,125 @@
+"""Update the cumulative coverage CSVs written by the previous run of
+compute_uptake_for_paper, rewriting only what has changed.
+
+Each week's extract adds a few days of events, and the counts for the earlier days
+are mostly unchanged.  The cubes of counts (see compute_uptake.build_uptake_cube)
+take little time to build from the whole cohort, and most of the time goes in
+formatting and writing the CSVs.  So with --incremental, compute_uptake_for_paper
+saves its cubes, and on the next run it slices each table from both the previous
+cubes and the new ones, and compares them:
+
+    * if the table is unchanged, its CSV is left as it is
+    * if the table has the same strata, and the same counts on each of the previous
+      days, the previous total row is cut off its CSV, and the rows for the new days
+      and the new total row are appended
+    * otherwise, the whole CSV is written again
+
+Since the new tables are always sliced from cubes built from the whole cohort, any
+change to the counts for earlier days (say, from a record that was entered late) is
+picked up, and the CSVs are the same as those written by a full run.  Before a CSV is
+appended to, we check that it ends with the previous total row, in case it has been
+written since.
+
+The saved cubes hold unrounded counts, so they are kept with the cohort, outside the
+outputs that are released.
+
+Incremental mode only works locally, where the output directory persists between
+runs.  On a backend, the state file is not an output of compute_uptake_for_paper in
+project.yaml, and a job is only given the outputs of the actions that it needs, so
+each run there finds no previous state and writes every CSV, as a full run does.
+"""
+
+import os
+import pickle
+
+import numpy as np
+
+default_state_path = "output/cumulative_coverage_state.pickle"
+
+
+def load_state(path, event_cols, stratification_cols):
+    """Return the cubes saved by the previous run, or None if there are none, or they
+    were built for other event or stratification columns."""
+
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        state = pickle.load(f)
+    if state["event_cols"] != event_cols or state["cols"] != stratification_cols:
+        return
+    return state["cubes"]
+
+
+def save_state(path, event_cols, stratification_cols, cubes):
+    state = {"event_cols": event_cols, "cols": stratification_cols, "cubes": cubes}
+    # Write to a temporary file first, so that a failed run leaves no partial state
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def remove_state(path):
+    """Remove any saved cubes, which will not match the CSVs written by a full run."""
+
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def write_uptake(uptake, previous, path):
+    """Write the table `uptake` to `path`, given `previous`, the table that was
+    written there by the previous run (or None)."""
+
+    if previous is not None and os.path.exists(path):
+        n_days = len(previous) - 1
+        if uptake.equals(previous):
+            if ends_with(path, format_rows(previous.iloc[n_days:])):
+                return
+        elif is_extension(uptake, previous):
+            if replace_tail(
+                path, format_rows(previous.iloc[n_days:]), format_rows(uptake.iloc[n_days:])
+            ):
+                return
+    uptake.to_csv(path)
+
+
+def is_extension(uptake, previous):
+    """Return whether `uptake` has the same strata as `previous`, and the same rows
+    for each of its days, followed by rows for later days."""
+
+    n_days = len(previous) - 1
+    return (
+        uptake.columns.equals(previous.columns)
+        and len(uptake) > len(previous)
+        and uptake.index[:n_days].equals(previous.index[:n_days])
+        and np.array_equal(uptake.values[:n_days], previous.values[:n_days])
+    )
+
+
+def format_rows(rows):
+    """Return the lines that to_csv writes for `rows`, without the header."""
+
+    return rows.to_csv(header=False).encode("utf8")
+
+
+def ends_with(path, tail):
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size < len(tail):
+            return False
+        f.seek(size - len(tail))
+        return f.read() == tail
+
+
+def replace_tail(path, tail, new_tail):
+    """Replace `tail`, at the end of the file at `path`, with `new_tail`, and return
+    whether the file ended with `tail`."""
+
+    if not ends_with(path, tail):
+        return False
+    with open(path, "r+b") as f:
+        f.seek(-len(tail), os.SEEK_END)
+        f.truncate()
+        f.write(new_tail)
+    return True
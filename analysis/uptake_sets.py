@@ -0,0 +1,71 @@
+"""Set algebra over uptake frames, as returned by compute_uptake.
+
+An uptake frame has a row for each day, with the cumulative number of patients in
+each stratum (column) with an event on or before that day, and a final "total" row
+with the number of patients in each stratum.  Each row is the size of a set of
+patients, so that:
+
+    * complement gives the patients without the event (for instance, those with no
+      vaccine related record, or "unreached")
+    * difference gives the patients with one event but not another, where the
+      patients with the other are a subset of those with the first
+    * union gives the patients with either of two events, where no patient has both
+
+Each works on the whole array of counts at once.  The counts are taken as they are,
+so if they have been rounded (as they are by compute_uptake), so are the results.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def complement(uptake):
+    """Return the number of patients in each stratum without the event by each day,
+    which is the total row minus each other row."""
+
+    values = uptake.values
+    total_ix = uptake.index.get_loc("total")
+    result = values[total_ix] - values
+    result[total_ix] = values[total_ix]
+    return pd.DataFrame(result, index=uptake.index, columns=uptake.columns)
+
+
+def difference(uptake, other):
+    """Return the number of patients with the event in `uptake` but not the event in
+    `other`, whose patients must be a subset of those in `uptake`."""
+
+    uptake, other = align(uptake, other)
+    result = uptake - other
+    result.loc["total"] = uptake.loc["total"]
+    return result
+
+
+def union(uptake, other):
+    """Return the number of patients with the event in either `uptake` or `other`,
+    whose patients must not overlap."""
+
+    uptake, other = align(uptake, other)
+    result = uptake + other
+    result.loc["total"] = uptake.loc["total"]
+    return result
+
+
+def align(uptake, other):
+    """Return both frames with the same days and strata.
+
+    A frame's cumulative counts are 0 before its first day, and carry on unchanged
+    after its last day.  A stratum that is missing from a frame has no patients with
+    the event, and its total is taken from the other frame.
+    """
+
+    days = sorted(set(uptake.index.drop("total")) | set(other.index.drop("total")))
+    columns = list(uptake.columns) + [col for col in other.columns if col not in uptake]
+    totals = uptake.loc["total"].combine_first(other.loc["total"]).reindex(columns)
+
+    aligned = []
+    for frame in [uptake, other]:
+        counts = frame.drop("total").reindex(days).ffill().fillna(0)
+        counts = counts.reindex(columns=columns, fill_value=0)
+        counts.loc["total"] = totals
+        aligned.append(counts.astype(np.int64))
+    return aligned
@@ -0,0 +1,98 @@
+"""The rules that assign each patient to a JCVI priority group ("wave").
+
+Both transforms assign waves from these rules, transform_fast for the whole cohort
+at once (with the functions below) and transform_slow one row at a time, so that the
+two cannot disagree.
+"""
+
+import numpy as np
+
+
+# Each rule is (wave, column, lower, upper).  A patient is in the first wave whose
+# rule they match: their age must be between lower (inclusive) and upper (exclusive),
+# where None means no limit, and if column is not None, the column must be set.
+# Patients who match no rule are in wave 0.
+wave_rules = [
+    # Wave 1: Residents in Care Homes
+    # (The spec includes staff in care homes, but occupation codes are not well
+    # recorded)
+    (1, "longres_dat", 65, None),
+    # Wave 2: Age 80 or over
+    # (This spec includes frontline H&SC workers, but see above.)
+    (2, None, 80, None),
+    # Wave 3: Age 70 - 79 ## modified from original group for this study
+    (3, None, 70, 80),
+    # Wave 4: Clinically Extremely Vulnerable ## modified from original group for this study
+    (4, "shield_group", None, None),
+    # Wave 5: Age 65 - 69
+    (5, None, 65, 70),
+    # Wave 6: Age 16-64 in a defined At Risk group
+    (6, "atrisk_group", 16, 65),
+    # Wave 7: Age 60 - 64
+    (7, None, 60, 65),
+    # Wave 8: Age 55 - 59
+    (8, None, 55, 60),
+    # Wave 9: Age 50 - 54
+    (9, None, 50, 55),
+]
+
+# Mapping from wave to combined wave ("wave2").  Waves not listed are in wave2 0.
+wave_to_wave2 = {
+    # Wave 2.1: Residents in Care Homes and those over 65 (waves 1-3 & 5)
+    1: 1,
+    2: 1,
+    3: 1,
+    5: 1,
+    # Wave 2.2: CEV (aged 16-69) and At Risk (aged 16-64)
+    4: 2,
+    6: 2,
+    # Wave 2.3: 50-64
+    7: 3,
+    8: 3,
+    9: 3,
+}
+
+# The waves in each combined wave, so that counts by combined wave can be summed from
+# counts by wave (see compute_uptake.roll_up_waves)
+wave2_waves = {}
+for wave in [0] + [wave for wave, _, _, _ in wave_rules]:
+    wave2_waves.setdefault(wave_to_wave2.get(wave, 0), []).append(wave)
+
+# The columns, other than age, that the rules read
+wave_rule_cols = [column for _, column, _, _ in wave_rules if column is not None]
+
+
+def add_waves(df):
+    """Add the wave of each patient, evaluating all the rules in a single pass."""
+
+    age = df["age"].values
+    conditions = []
+    for _, column, lower, upper in wave_rules:
+        condition = np.ones(len(df), dtype=bool)
+        if column is not None:
+            condition &= is_set(df[column])
+        if lower is not None:
+            condition &= lower <= age
+        if upper is not None:
+            condition &= age < upper
+        conditions.append(condition)
+
+    # np.select picks the wave of the first rule that matches
+    df["wave"] = np.select(conditions, [wave for wave, _, _, _ in wave_rules], 0)
+
+
+def add_waves_2(df):
+    """Add the combined wave of each patient, by looking up their wave."""
+
+    lookup = np.zeros(max(wave for wave, _, _, _ in wave_rules) + 1, dtype=np.int64)
+    for wave, wave2 in wave_to_wave2.items():
+        lookup[wave] = wave2
+    df["wave2"] = lookup[df["wave"].values]
+
+
+def is_set(series):
+    """Return whether each value is set: not null for dates, and true otherwise."""
+
+    if series.dtype.kind == "M":
+        return series.notnull().values
+    return series.values.astype(bool)